@@ -1,37 +1,53 @@
+import pathlib
 import re
-from typing import List
+from typing import List, Dict, Optional
 
 import fitz
 
-from remarks.conversion import check_rm_file_version
-from remarks.conversion.parsing import determine_document_dimensions
-from remarks.dimensions import REMARKABLE_DOCUMENT, ReMarkableDimensions
+from remarks.conversion.parsing import ParsedPage
+from remarks.dimensions import REMARKABLE_DOCUMENT
 from remarks.utils import (
     get_document_filetype,
     get_document_tags,
-    get_page_tags,
+    get_page_tags_index,
     is_inserted_page,
     get_pages_data,
     list_ann_rm_files,
     get_visible_name, is_duplicate_page,
+    MetadataStore,
 )
 
 
 class Document:
-    def __init__(self, metadata_path):
+    def __init__(self, metadata_path, store: Optional[MetadataStore] = None):
         self.metadata_path = metadata_path
-        self.pages_list, self.pages_map = get_pages_data(metadata_path)
-        self.doc_type = get_document_filetype(metadata_path)
-        self.name = sanitize_filename(get_visible_name(metadata_path))
+        self.store = store or MetadataStore()
+        self.source = self.store.source
+        self.pages_list, self.pages_map = get_pages_data(metadata_path, store=self.store)
+        self.doc_type = get_document_filetype(metadata_path, store=self.store)
+        self.name = sanitize_filename(get_visible_name(metadata_path, store=self.store))
 
         # annotations
-        self.rm_tags = list(get_document_tags(metadata_path))
-        self.rm_annotation_files = list_ann_rm_files(metadata_path)
+        self.rm_tags = list(get_document_tags(metadata_path, store=self.store))
+        self.page_tags = get_page_tags_index(metadata_path, store=self.store)
+        self.rm_annotation_files = list_ann_rm_files(metadata_path, self.source)
+        # Built once, so matching pages to their position and .rm file doesn't rescan the lists for every page
+        self.page_indices: Dict[str, int] = {}
+        for page_idx, page_uuid in enumerate(self.pages_list):
+            self.page_indices.setdefault(page_uuid, page_idx)
+        self.rm_annotation_paths: Dict[str, pathlib.Path] = {f.stem: f for f in self.rm_annotation_files}
+        # .rm files are read and decoded at most once, then shared by every stage that needs them
+        self._parsed_pages: Dict[pathlib.Path, ParsedPage] = {}
+
+    def parsed_page(self, rm_annotation_file: pathlib.Path) -> ParsedPage:
+        if rm_annotation_file not in self._parsed_pages:
+            self._parsed_pages[rm_annotation_file] = ParsedPage.from_file(rm_annotation_file, self.source)
+        return self._parsed_pages[rm_annotation_file]
 
     def open_source_pdf(self) -> fitz.Document:
         if self.doc_type in ["pdf", "epub"]:
             f = self.metadata_path.with_name(f"{self.metadata_path.stem}.pdf")
-            pdf_src = fitz.open(f)
+            pdf_src = self.source.open_pdf(f)
             source_pdf_page_count = pdf_src.page_count
 
             # Track how many pages we've added so we insert at correct positions
@@ -72,25 +88,12 @@ class Document:
             #
             # reMarkable's desktop app exports notebooks to PDF with 445 x 594, in
             # terms of scale it is 445/1404 = ~0.316
-            # Open an empty PDF to be treated as if it were the original document
+            # Open an empty PDF to be treated as if it were the original document.
+            # Pages start out at the default size, and are sized to their drawing by `fit_notebook_page` once their
+            # .rm file is parsed anyway, so no page is decoded just to size it.
             pdf_src = fitz.open()
-            page_sizes: List[ReMarkableDimensions] = []
-            for page in self.pages_list:
-                paths = filter(
-                    lambda _ann_page: _ann_page.stem == page, self.rm_annotation_files
-                )
-                path = next(paths, None)
-                if path:
-                    try:
-                        page_sizes.append(determine_document_dimensions(path))
-                    except ValueError:
-                        page_sizes.append(REMARKABLE_DOCUMENT)
-                else:
-                    page_sizes.append(REMARKABLE_DOCUMENT)
-
-            # For each note page, add a blank page to the original document
-            for i, dims in enumerate(page_sizes):
-                mu_dims = dims.to_mm().to_mu()
+            mu_dims = REMARKABLE_DOCUMENT.to_mm().to_mu()
+            for i in range(len(self.pages_list)):
                 pdf_src.new_page(
                     width=mu_dims.width,
                     height=mu_dims.height,
@@ -99,33 +102,40 @@ class Document:
 
         return pdf_src
 
+    def fit_notebook_page(self, page: fitz.Page, parsed_page: ParsedPage):
+        """Size a notebook page to its drawing, which can extend beyond the screen on v6 pages"""
+        if self.doc_type != "notebook":
+            return
+        try:
+            mu_dims = parsed_page.dimensions().to_mm().to_mu()
+        except ValueError:
+            return
+        page.set_mediabox(fitz.Rect(0, 0, mu_dims.width, mu_dims.height))
+
     def pages(self):
-        page_uuids = set(
-            [f.stem for f in self.rm_annotation_files]
+        # Orphaned .rm files (e.g. page was deleted but file remains) don't have an index
+        annotated_pages = sorted(
+            (page_idx, page_uuid)
+            for page_uuid, page_idx in self.page_indices.items()
+            if page_uuid in self.rm_annotation_paths
         )
 
-        for page_uuid in page_uuids:
-            if page_uuid not in self.pages_list:
-                # Orphaned .rm file (e.g. page was deleted but file remains)
-                continue
-
-            rm_annotation_file = None
-
-            page_idx = self.pages_list.index(f"{page_uuid}")
-
-            for f in self.rm_annotation_files:
-                if page_uuid == f.stem and check_rm_file_version(f):
-                    rm_annotation_file = f
+        for page_idx, page_uuid in annotated_pages:
+            f = self.rm_annotation_paths[page_uuid]
+            parsed_page = self.parsed_page(f) if self.parsed_page(f).is_valid() else None
 
             yield (
                 page_uuid,
                 page_idx,
-                rm_annotation_file,
+                parsed_page,
             )
+
+            # The page has been fully processed, release its bytes and scene tree
+            self._parsed_pages.pop(f, None)
     
     def get_page_tags_for_page(self, page_uuid: str) -> List[str]:
         """Get tags for a specific page"""
-        return get_page_tags(self.metadata_path, page_uuid)
+        return self.page_tags.get(page_uuid, [])
 
 
 def sanitize_filename(filename: str) -> str:
@@ -1,6 +1,6 @@
 from . import conversion
 
-from .remarks import run_remarks
+from .remarks import run_remarks, RemarksSummary
 
 from .utils import (
     get_visible_name,
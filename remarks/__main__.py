@@ -1,8 +1,11 @@
 import argparse
 import logging
 import pathlib
+import sys
 
 from remarks import run_remarks
+from remarks.cache import RenderCache, DEFAULT_RENDER_CACHE_SIZE
+from remarks.output.PdfFile import PDF_SAVE_PROFILES, DEFAULT_PDF_SAVE_PROFILE
 from rmc.exporters.svg import DEVICE_PROFILES
 
 __prog_name__ = "remarks"
@@ -47,6 +50,59 @@ def main():
         help="Device type (overrides auto-detection)",
         metavar="DEVICE",
     )
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="Render annotation layers to PDF in memory, instead of through temporary PDF files",
+    )
+    parser.add_argument(
+        "--combined-highlights",
+        action="store_true",
+        help="Add a single highlight annotation for each highlight, covering all of its lines, instead of one annotation per rectangle",
+    )
+    parser.add_argument(
+        "--pdf-profile",
+        choices=list(PDF_SAVE_PROFILES.keys()),
+        default=DEFAULT_PDF_SAVE_PROFILE,
+        help="How output PDFs are saved: fast saves them as they are, compact takes longer and makes them smaller (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Let go of every page's annotation layer as soon as the page is finished, for documents with many pages. A little slower.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep a cache in OUTPUT_DIRECTORY/.remarks-cache, skip documents that did not change since the last run and only re-render the pages that did",
+    )
+    parser.add_argument(
+        "--render-cache",
+        help="Directory in which rendered annotation layers are kept, so pages with the same content are only rendered once, across documents and runs",
+        metavar="DIRECTORY",
+    )
+    parser.add_argument(
+        "--render-cache-size",
+        type=int,
+        default=DEFAULT_RENDER_CACHE_SIZE,
+        help=f"Size limit of the render cache in megabytes, the least recently used layers are evicted beyond it. Defaults to {DEFAULT_RENDER_CACHE_SIZE}",
+        metavar="MB",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of documents to process in parallel, each in its own process. Use 0 for one per CPU core. Defaults to 1",
+        metavar="N",
+    )
+    parser.add_argument(
+        "--page-jobs",
+        type=int,
+        default=1,
+        help="Number of pages of a single document to parse and render in parallel, each in its own process. Useful for very large documents. Defaults to 1",
+        metavar="N",
+    )
 
     args = parser.parse_args()
     args_dict = vars(args)
@@ -54,6 +110,15 @@ def main():
     input_dir = pathlib.Path(args_dict.pop("input_dir"))
     output_dir = pathlib.Path(args_dict.pop("output_dir"))
     device = args_dict.pop("device")
+    in_memory = args_dict.pop("in_memory")
+    jobs = args_dict.pop("jobs")
+    page_jobs = args_dict.pop("page_jobs")
+    incremental = args_dict.pop("incremental")
+    combined_highlights = args_dict.pop("combined_highlights")
+    pdf_profile = args_dict.pop("pdf_profile")
+    low_memory = args_dict.pop("low_memory")
+    render_cache_dir = args_dict.pop("render_cache")
+    render_cache_size = args_dict.pop("render_cache_size")
 
     log_level = args_dict.pop("log_level")
     logging.basicConfig(
@@ -67,7 +132,25 @@ def main():
     if not output_dir.exists():
         output_dir.mkdir(parents=True, exist_ok=True)
 
-    run_remarks(input_dir, output_dir, device=device)
+    if jobs < 0:
+        parser.error("--jobs must be 0 or a positive number")
+    if page_jobs < 1:
+        parser.error("--page-jobs must be a positive number")
+    if render_cache_size < 1:
+        parser.error("--render-cache-size must be a positive number")
+
+    render_cache = None
+    if render_cache_dir:
+        render_cache = RenderCache(pathlib.Path(render_cache_dir), render_cache_size * 1024 * 1024)
+
+    summary = run_remarks(input_dir, output_dir, device=device, in_memory=in_memory, workers=jobs,
+                          page_workers=page_jobs, incremental=incremental, render_cache=render_cache,
+                          combined_highlights=combined_highlights, pdf_profile=pdf_profile, low_memory=low_memory)
+
+    for document, error in summary.failed.items():
+        logging.error(f'Could not convert "{document}": {error}')
+    if summary.failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import time
+from typing import Dict, List, Optional, Tuple
+
+import fitz
+
+from remarks.Document import Document
+from remarks.sources import InputSource
+
+CACHE_DIRECTORY_NAME = ".remarks-cache"
+
+# Bump this whenever a change to remarks changes what the output of an unchanged input looks like,
+# so that documents converted by an older version are converted again.
+CACHE_VERSION = 2
+
+
+def file_hash(path: pathlib.Path, source: Optional[InputSource] = None) -> Optional[str]:
+    if source:
+        return hashlib.sha256(source.read_bytes(path)).hexdigest() if source.exists(path) else None
+    if not path.exists():
+        return None
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class DocumentCache:
+    """Remembers what a document looked like the last time it was converted into an output directory.
+
+    Every document gets a directory in `{output_dir}/.remarks-cache/{document uuid}/`, holding a JSON manifest
+    with the hashes of its .metadata, .content, source pdf and each page's .rm file, next to the finished PDF
+    page of every annotated page. Documents are therefore independent of each other, and can safely be converted
+    in parallel."""
+
+    def __init__(self, output_dir: pathlib.Path, document: Document, options: Dict, outputs: List[pathlib.Path]):
+        metadata_path = document.metadata_path
+        source = document.source
+        self.directory = output_dir / CACHE_DIRECTORY_NAME / metadata_path.stem
+        self.manifest_path = self.directory / "manifest.json"
+        self.outputs = outputs
+
+        self.previous = {}
+        if self.manifest_path.exists():
+            try:
+                with open(self.manifest_path) as f:
+                    self.previous = json.load(f)
+            except ValueError:
+                logging.warning(f"Ignoring corrupt conversion cache manifest {self.manifest_path}")
+
+        self.current = {
+            "version": CACHE_VERSION,
+            "options": options,
+            "metadata": file_hash(metadata_path, source),
+            "content": file_hash(metadata_path.with_name(f"{metadata_path.stem}.content"), source),
+            "pdf": file_hash(metadata_path.with_name(f"{metadata_path.stem}.pdf"), source),
+            "pages": {f.stem: file_hash(f, source) for f in document.rm_annotation_files},
+            "outputs": [str(output) for output in outputs],
+            # Pages whose finished PDF page is stored in the cache
+            "finished_pages": [],
+        }
+
+    def is_unchanged(self) -> bool:
+        """Nothing changed since the last conversion, and its output is still there"""
+        inputs = [key for key in self.current if key != "finished_pages"]
+        return (all(self.previous.get(key) == self.current[key] for key in inputs)
+                and all(output.exists() for output in self.outputs))
+
+    def _background_is_unchanged(self) -> bool:
+        # The .metadata only holds things like the name and the folder, it doesn't affect what a page looks like
+        return all(self.previous.get(key) == self.current[key] for key in ["version", "options", "content", "pdf"])
+
+    def _page_path(self, page_uuid: str) -> pathlib.Path:
+        return self.directory / f"{page_uuid}.pdf"
+
+    def cached_page(self, page_uuid: str) -> Optional[fitz.Document]:
+        """The finished page from the last conversion, if neither the page nor its background changed since"""
+        if not self._background_is_unchanged():
+            return None
+        if page_uuid not in self.previous.get("finished_pages", []):
+            return None
+        if self.previous["pages"].get(page_uuid) != self.current["pages"].get(page_uuid):
+            return None
+        page_path = self._page_path(page_uuid)
+        if not page_path.exists():
+            return None
+        self.current["finished_pages"].append(page_uuid)
+        return fitz.open(page_path)
+
+    def store_page(self, page_uuid: str, document: fitz.Document, page_idx: int):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        page = fitz.open()
+        page.insert_pdf(document, from_page=page_idx, to_page=page_idx)
+        page.save(self._page_path(page_uuid))
+        self.current["finished_pages"].append(page_uuid)
+
+    def save(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Drop finished pages that are outdated, or belong to pages that no longer exist
+        for page_path in self.directory.glob("*.pdf"):
+            if page_path.stem not in self.current["finished_pages"]:
+                page_path.unlink()
+
+        with open(self.manifest_path, "w") as f:
+            json.dump(self.current, f, indent=2)
+
+
+# The default size limit of the rendered page cache, in megabytes
+DEFAULT_RENDER_CACHE_SIZE = 512
+
+
+class RenderCache:
+    """Rendered annotation layers, addressed by the content of their .rm file and the page settings used to render them.
+
+    The same .rm content shows up over and over: duplicated pages, or templates copied across notebooks. Each
+    rendered layer is stored as a single page PDF named after its key. Reading a layer bumps its modification time,
+    and once the cache grows beyond `max_size` bytes the least recently used layers are evicted.
+
+    The size of the cache is kept track of as layers are added, the directory is only listed again once that
+    estimate goes over `max_size`. Layers added by other processes in the meantime are counted from then on."""
+
+    def __init__(self, directory: pathlib.Path, max_size: int = DEFAULT_RENDER_CACHE_SIZE * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def key(rm_data: bytes, *settings) -> str:
+        digest = hashlib.sha256(rm_data)
+        digest.update(json.dumps([CACHE_VERSION, *settings]).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.pdf"
+
+    def get(self, key: str) -> Optional[fitz.Document]:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            self._mark_used(path)
+        except FileNotFoundError:
+            return None
+        return fitz.open(stream=data, filetype="pdf")
+
+    def put(self, key: str, document: fitz.Document):
+        # Written next to its final name and then renamed, other processes never see a partial file
+        path = self._path(key)
+        partial_path = path.with_name(f"{path.name}.{os.getpid()}.partial")
+        data = document.tobytes()
+        partial_path.write_bytes(data)
+        self._mark_used(partial_path)
+        os.replace(partial_path, path)
+
+        self._size += len(data)
+        if self._size > self.max_size:
+            self.evict()
+
+    @staticmethod
+    def _mark_used(path: pathlib.Path):
+        # Explicit timestamps, the file system clock is often too coarse to order layers used in quick succession
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+
+    def _entries(self) -> List[Tuple[int, int, pathlib.Path]]:
+        entries = []
+        for path in self.directory.glob("*.pdf"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Evicted by another process in the meantime
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = self._entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+        self._size = total_size
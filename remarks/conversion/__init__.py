@@ -1,4 +1,5 @@
 from .parsing import (
+    ParsedPage,
     parse_rm_file,
     check_rm_file_version
 )
@@ -6,6 +7,7 @@ from .parsing import (
 from .text import (
     check_if_text_extractable,
     extract_groups_from_pdf_ann_hl,
+    get_page_word_index,
     extract_groups_from_smart_hl,
     prepare_md_from_hl_groups,
 )
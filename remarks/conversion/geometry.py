@@ -0,0 +1,108 @@
+"""Geometry of word boxes and highlight rectangles, computed for a whole page at once.
+
+Rectangles are rows of `(x0, y0, x1, y1)` in a NumPy array. The tests follow the semantics of `fitz.Rect`, so the
+results are the same as comparing every word with every rectangle one `fitz.Rect` at a time.
+
+These only back the helpers that read highlights from the annotations of a PDF page, `extract_groups_from_pdf_ann_hl`
+and `extract_annot`. The conversion itself takes its highlights from the .rm files, and doesn't use them."""
+from typing import Iterable, Sequence
+
+import numpy as np
+
+
+def rect_array(rects: Iterable[Sequence[float]]) -> np.ndarray:
+    """An (n, 4) array of rectangles, from anything with the coordinates as its first four items.
+
+    That includes `fitz.Rect` and the word tuples of `page.get_text("words")`."""
+    array = np.array([tuple(rect[:4]) for rect in rects], dtype=np.float64)
+    return array.reshape(-1, 4)
+
+
+def _is_empty(rects: np.ndarray) -> np.ndarray:
+    return (rects[:, 0] >= rects[:, 2]) | (rects[:, 1] >= rects[:, 3])
+
+
+def _area(rects: np.ndarray) -> np.ndarray:
+    return np.maximum(0, rects[:, 2] - rects[:, 0]) * np.maximum(0, rects[:, 3] - rects[:, 1])
+
+
+def intersects_any(words: np.ndarray, rects: np.ndarray) -> np.ndarray:
+    """For every word, whether it intersects any of the rectangles, like `fitz.Rect.intersects`.
+
+    Empty rectangles intersect nothing, and rectangles that merely touch don't intersect."""
+    if len(words) == 0 or len(rects) == 0:
+        return np.zeros(len(words), dtype=bool)
+
+    rects = rects[~_is_empty(rects)]
+    w = words[:, np.newaxis, :]
+    overlaps = ((w[..., 0] < rects[:, 2]) & (rects[:, 0] < w[..., 2])
+                & (w[..., 1] < rects[:, 3]) & (rects[:, 1] < w[..., 3]))
+    return ~_is_empty(words) & overlaps.any(axis=1)
+
+
+def intersection_areas(words: np.ndarray, rect: Sequence[float]) -> np.ndarray:
+    """The area of every word's intersection with `rect`, like `fitz.Rect(rect).intersect(word).get_area()`"""
+    rect = np.asarray(rect[:4], dtype=np.float64)
+    if rect[0] >= rect[2] or rect[1] >= rect[3]:
+        # An empty rectangle stays as it is, and still has no area
+        return np.zeros(len(words))
+
+    # MuPDF intersects rectangles in single precision
+    words32 = words.astype(np.float32)
+    rect32 = rect.astype(np.float32)
+    intersections = np.column_stack([
+        np.maximum(words32[:, 0], rect32[0]), np.maximum(words32[:, 1], rect32[1]),
+        np.minimum(words32[:, 2], rect32[2]), np.minimum(words32[:, 3], rect32[3]),
+    ]).astype(np.float64)
+    # An empty word replaces the rectangle altogether
+    return np.where(_is_empty(words), _area(words), _area(intersections))
+
+
+def contained_in(words: np.ndarray, rect: Sequence[float], min_overlap: float = 0.5) -> np.ndarray:
+    """For every word, whether at least `min_overlap` of its area lies within `rect`.
+
+    The same test as `check_contain` in `remarks.output.PdfFile`, for all words of a page at once."""
+    return intersection_areas(words, rect) >= _area(words) * min_overlap
+
+
+class WordIndex:
+    """The words of a page, indexed by their vertical position.
+
+    Built once per page from the word tuples of `page.get_text("words")`, after which a rectangle only looks at the
+    words on the lines it covers instead of at every word of the page. One index serves every lookup of annotation
+    geometry on that page, by `extract_annot` or `extract_groups_from_pdf_ann_hl`."""
+
+    def __init__(self, words: Sequence[tuple]):
+        self.words = words
+        self.boxes = rect_array(words)
+
+        empty = _is_empty(self.boxes)
+        # Empty words are contained in any rectangle, and intersect none
+        self._empty = np.flatnonzero(empty)
+        self._order = np.flatnonzero(~empty)
+        self._order = self._order[np.argsort(self.boxes[self._order, 1], kind="stable")]
+        self._tops = self.boxes[self._order, 1]
+        heights = self.boxes[self._order, 3] - self._tops
+        self._max_height = heights.max() if len(heights) else 0
+
+    def _candidates(self, rect: Sequence[float]) -> np.ndarray:
+        """The non-empty words that overlap the rectangle vertically, and a few more"""
+        # A word that starts more than the tallest word above the rectangle ends above it,
+        # a word that starts at or below its bottom doesn't reach into it.
+        start = np.searchsorted(self._tops, rect[1] - self._max_height, side="left")
+        end = np.searchsorted(self._tops, rect[3], side="left")
+        return self._order[start:end]
+
+    def intersecting(self, rects: Iterable[Sequence[float]]) -> np.ndarray:
+        """For every word, whether it intersects any of the rectangles, like `intersects_any`"""
+        mask = np.zeros(len(self.words), dtype=bool)
+        for rect in rect_array(rects):
+            candidates = self._candidates(rect)
+            mask[candidates] |= intersects_any(self.boxes[candidates], rect[np.newaxis, :])
+        return mask
+
+    def contained(self, rect: Sequence[float], min_overlap: float = 0.5) -> list:
+        """The words of which at least `min_overlap` of the area lies within `rect`, like `contained_in`, in order"""
+        candidates = self._candidates(rect)
+        candidates = candidates[contained_in(self.boxes[candidates], rect, min_overlap)]
+        return [self.words[i] for i in np.sort(np.concatenate([candidates, self._empty]))]
@@ -1,11 +1,13 @@
+import io
 import logging
 import struct
-from dataclasses import dataclass
-from typing import List, TypedDict, Tuple
+from typing import List, Optional, TypedDict, Tuple
+
+import numpy as np
 
 from rmc.exporters.svg import rmc_config
 from rmscene import read_blocks, SceneTree, build_tree, RootTextBlock
-from rmscene.scene_items import Line, GlyphRange, Rectangle
+from rmscene.scene_items import Line, GlyphRange, PenColor
 from rmscene.text import TextDocument
 
 from ..dimensions import ReMarkableDimensions
@@ -23,10 +25,35 @@ def update_boundaries_from_point(x, y, boundaries):
     boundaries["y_min"] = min(boundaries["y_min"], y)
 
 
-@dataclass
-class RemarksRectangle:
-    color: int
-    rectangles: List[Rectangle]
+class Highlight:
+    """A smart highlight, the only thing kept of rmscene's GlyphRange once a page is parsed.
+
+    Its rectangles are an (n, 4) array of `(x, y, w, h)` rows, already translated to PDF coordinates and sorted in
+    reading order. `color` is the value of its PenColor."""
+    __slots__ = ("start", "length", "text", "color", "boxes")
+
+    def __init__(self, start: Optional[int], length: int, text: str, color: int, boxes: np.ndarray):
+        self.start = start
+        self.length = length
+        self.text = text
+        self.color = color
+        self.boxes = boxes
+
+    @classmethod
+    def from_glyph_range(cls, glyph_range: GlyphRange) -> "Highlight":
+        boxes = np.array([
+            (rmc_config.xx(rectangle.x), rmc_config.yy(rectangle.y),
+             rmc_config.xx(rectangle.w), rmc_config.yy(rectangle.h))
+            for rectangle in glyph_range.rectangles
+        ], dtype=np.float64).reshape(-1, 4)
+        # sort by reading order
+        boxes = boxes[np.lexsort((boxes[:, 0], boxes[:, 1]))]
+        return cls(glyph_range.start, glyph_range.length, glyph_range.text, glyph_range.color.value, boxes)
+
+    def to_glyph_range(self) -> GlyphRange:
+        """The highlight as the markdown writer merges it. It only shows the text, the rectangles are left out."""
+        return GlyphRange(start=self.start, length=self.length, text=self.text, color=PenColor(self.color),
+                          rectangles=[])
 
 
 class TTextBlock(TypedDict):
@@ -37,99 +64,43 @@ class TTextBlock(TypedDict):
 
 
 class TMetaData(TypedDict):
-    glyph_ranges: List[GlyphRange]
-    highlights: List[RemarksRectangle]
+    highlights: List[Highlight]
     text: TTextBlock | None
     scene_tree: SceneTree | None
 
 
-def parse_v6(file_path: str) -> Tuple[TMetaData, bool]:
-    output: TMetaData = {
-        "highlights": [],
-        "glyph_ranges": [],
-        "text": None,
-        "scene_tree": None
-    }
-
-    with open(file_path, "rb") as f:
-        tree = SceneTree()
-        blocks = [b for b in read_blocks(f)]
-        build_tree(tree, blocks)
-
-        output["scene_tree"] = tree
-
-        try:
-            for block in blocks:
-                if isinstance(block, RootTextBlock):
-                    output["text"] = {
-                        "pos_x": block.value.pos_x,
-                        "pos_y": block.value.pos_y,
-                        "width": block.value.width,
-                        "text": TextDocument.from_scene_item(tree.root_text),
-                    }
-            for el in tree.walk():
-                if isinstance(el, GlyphRange):
-                    translated_rectangles = [
-                        Rectangle(
-                            x=rmc_config.xx(rectangle.x),
-                            y=rmc_config.yy(rectangle.y),
-                            w=rmc_config.xx(rectangle.w),
-                            h=rmc_config.yy(rectangle.h)
-                        ) for rectangle in el.rectangles]
-                    # sort by reading order
-                    translated_rectangles.sort(key=lambda h: (h.y, h.x))
-                    highlight: RemarksRectangle = RemarksRectangle(
-                        color=el.color.value,
-                        rectangles=translated_rectangles)
-                    output["glyph_ranges"].append(el)
-                    output["highlights"].append(highlight)
-        except AssertionError:
-            print("ReMarkable broken data")
-
-    return output, False
-
+EXPECTED_HEADER_FMT = b"reMarkable .lines file, version=0          "
+EXPECTED_HEADER_V3 = b"reMarkable .lines file, version=3          "
+EXPECTED_HEADER_V5 = b"reMarkable .lines file, version=5          "
+EXPECTED_HEADER_V6 = b"reMarkable .lines file, version=6          "
+HEADER_FMT = f"<{len(EXPECTED_HEADER_FMT)}sI"
 
-def determine_document_dimensions(file_path) -> ReMarkableDimensions:
-    """The ReMarkable has dynamic document size in v6. The dimensions are not available anywhere, so we'll compute
-    them from points"""
-    # This is the horizontal space you get as defined by ReMarkable.
-    # Not coincidentally, this is (RM_HEIGHT - RM_WIDTH)/2
-    # Adding two increments, which is the max, you end up with an exactly square aspect ratio
-    # hori = (RM_HEIGHT - RM_WIDTH) / 2
-    dims = {
-        "x_min": -RM_WIDTH / 2,
-        "x_max": RM_WIDTH / 2 - 1,
-        "y_min": 0,
-        "y_max": RM_HEIGHT - 1,
-    }
-    with open(file_path, "rb") as f:
-        blocks = read_blocks(f)
-        tree = SceneTree()
-        build_tree(tree, blocks)
 
-        try:
-            for el in tree.walk():
-                if isinstance(el, Line):
-                    for p in el.points:
-                        update_boundaries_from_point(p.x, p.y, dims)
-        except AssertionError:
-            print("ReMarkable broken data")
+class ParsedPage:
+    """A single .rm file, read from disk exactly once.
 
-    return ReMarkableDimensions(
-        dims["x_max"] - dims["x_min"], dims["y_max"] - dims["y_min"]
-    )
+    The raw bytes are read up front. The rmscene blocks and the scene tree are decoded on first use and then shared
+    by every stage that needs them: version detection, dimensions, highlights, typed text and rendering."""
 
+    def __init__(self, file_path, data: bytes):
+        self.file_path = file_path
+        self.data = data
+        self._blocks = None
+        self._scene_tree = None
+        self._annotations = None
 
-def read_rm_file_version(file_path: str) -> str:
-    with open(file_path, "rb") as f:
-        src_header = f.readline()
+    @classmethod
+    def from_file(cls, file_path, source=None) -> "ParsedPage":
+        if source:
+            return cls(file_path, source.read_bytes(file_path))
+        with open(file_path, "rb") as f:
+            return cls(file_path, f.read())
 
+    @property
+    def version(self) -> str:
         # 32nd character (marked with V) is the version number
         #                                                       V
-        expected_header_fmt = b"reMarkable .lines file, version=0          "
-        fmt = f"<{len(expected_header_fmt)}sI"
-        header, nlayers = struct.unpack_from(fmt, src_header, 0)
-        # 32nd character is the version number
+        header, nlayers = struct.unpack_from(HEADER_FMT, self.data, 0)
         version = chr(header[32])
 
         if version == "3":
@@ -139,67 +110,132 @@ def read_rm_file_version(file_path: str) -> str:
         else:
             return ReMarkableAnnotationsFileHeaderVersion.UNKNOWN
 
+    def is_valid(self) -> bool:
+        if len(self.data) < len(EXPECTED_HEADER_FMT) + 4:
+            logging.error(f"- .rm file ({self.file_path}) seems too short to be valid")
+            return False
 
-def check_rm_file_version(file_path):
-    with open(file_path, "rb") as f:
-        data = f.read()
+        header, nlayers = struct.unpack_from(HEADER_FMT, self.data, 0)
 
-    expected_header_fmt = b"reMarkable .lines file, version=0          "
+        is_v3 = header == EXPECTED_HEADER_V3
+        is_v5 = header == EXPECTED_HEADER_V5
+        is_v6 = header == EXPECTED_HEADER_V6
 
-    if len(data) < len(expected_header_fmt) + 4:
-        logging.error(f"- .rm file ({file_path}) seems too short to be valid")
-        return False
+        if is_v6:
+            return True
 
-    offset = 0
-    fmt = f"<{len(expected_header_fmt)}sI"
+        if (not is_v3 and not is_v5) or nlayers < 1:
+            logging.error(
+                f"- .rm file ({self.file_path}) doesn't look like a valid one: <header={header}><nlayers={nlayers}>"
+            )
+            return False
 
-    header, nlayers = struct.unpack_from(fmt, data, offset)
+        return True
 
-    is_v3 = header == b"reMarkable .lines file, version=3          "
-    is_v5 = header == b"reMarkable .lines file, version=5          "
-    is_v6 = header == b"reMarkable .lines file, version=6          "
+    @property
+    def blocks(self) -> list:
+        if self._blocks is None:
+            self._blocks = list(read_blocks(io.BytesIO(self.data)))
+        return self._blocks
+
+    @property
+    def scene_tree(self) -> SceneTree:
+        if self._scene_tree is None:
+            tree = SceneTree()
+            build_tree(tree, self.blocks)
+            self._scene_tree = tree
+        return self._scene_tree
+
+    def dimensions(self) -> ReMarkableDimensions:
+        """The ReMarkable has dynamic document size in v6. The dimensions are not available anywhere, so we'll compute
+        them from points"""
+        # This is the horizontal space you get as defined by ReMarkable.
+        # Not coincidentally, this is (RM_HEIGHT - RM_WIDTH)/2
+        # Adding two increments, which is the max, you end up with an exactly square aspect ratio
+        # hori = (RM_HEIGHT - RM_WIDTH) / 2
+        dims = {
+            "x_min": -RM_WIDTH / 2,
+            "x_max": RM_WIDTH / 2 - 1,
+            "y_min": 0,
+            "y_max": RM_HEIGHT - 1,
+        }
+        tree = self.scene_tree
 
-    if is_v6:
-        return True
+        try:
+            for el in tree.walk():
+                if isinstance(el, Line):
+                    for p in el.points:
+                        update_boundaries_from_point(p.x, p.y, dims)
+        except AssertionError:
+            print("ReMarkable broken data")
 
-    if (not is_v3 and not is_v5) or nlayers < 1:
-        logging.error(
-            f"- .rm file ({file_path}) doesn't look like a valid one: <header={header}><nlayers={nlayers}>"
+        return ReMarkableDimensions(
+            dims["x_max"] - dims["x_min"], dims["y_max"] - dims["y_min"]
         )
-        return False
 
-    return True
+    def annotations(self) -> TMetaData:
+        if self._annotations is not None:
+            return self._annotations
+
+        output: TMetaData = {
+            "highlights": [],
+            "text": None,
+            "scene_tree": None
+        }
+
+        tree = self.scene_tree
+        output["scene_tree"] = tree
+
+        try:
+            for block in self.blocks:
+                if isinstance(block, RootTextBlock):
+                    output["text"] = {
+                        "pos_x": block.value.pos_x,
+                        "pos_y": block.value.pos_y,
+                        "width": block.value.width,
+                        "text": TextDocument.from_scene_item(tree.root_text),
+                    }
+            for el in tree.walk():
+                if isinstance(el, GlyphRange):
+                    output["highlights"].append(Highlight.from_glyph_range(el))
+        except AssertionError:
+            print("ReMarkable broken data")
+
+        self._annotations = output
+        return output
 
+    def parse(self) -> Tuple[Tuple[TMetaData, bool], str]:
+        if len(self.data) < len(EXPECTED_HEADER_V5) + 4:
+            raise ValueError(f"{self.file_path} is too short to be a valid .rm file")
 
-def parse_rm_file(file_path: str) -> Tuple[Tuple[TMetaData, bool], str]:
-    with open(file_path, "rb") as f:
-        data = f.read()
+        header, nlayers = struct.unpack_from(HEADER_FMT, self.data, 0)
 
-    expected_header_fmt = b"reMarkable .lines file, version=0          "
+        if header == EXPECTED_HEADER_V6:
+            return (self.annotations(), False), "V6"
 
-    expected_header_v3 = b"reMarkable .lines file, version=3          "
-    expected_header_v5 = b"reMarkable .lines file, version=5          "
-    expected_header_v6 = b"reMarkable .lines file, version=6          "
-    if len(data) < len(expected_header_v5) + 4:
-        raise ValueError(f"{file_path} is too short to be a valid .rm file")
+        raise ValueError(
+            f"{self.file_path} is not a valid .rm file: <header={header}><nlayers={nlayers}>"
+        )
 
-    offset = 0
-    fmt = f"<{len(expected_header_fmt)}sI"
 
-    header, nlayers = struct.unpack_from(fmt, data, offset)
+def parse_v6(file_path: str) -> Tuple[TMetaData, bool]:
+    return ParsedPage.from_file(file_path).annotations(), False
+
+
+def determine_document_dimensions(file_path) -> ReMarkableDimensions:
+    return ParsedPage.from_file(file_path).dimensions()
 
-    offset += struct.calcsize(fmt)
 
-    is_v3 = header == expected_header_v3
-    is_v5 = header == expected_header_v5
-    is_v6 = header == expected_header_v6
+def read_rm_file_version(file_path: str) -> str:
+    return ParsedPage.from_file(file_path).version
+
+
+def check_rm_file_version(file_path):
+    return ParsedPage.from_file(file_path).is_valid()
 
-    if is_v6:
-        return parse_v6(file_path), "V6"
 
-    raise ValueError(
-        f"{file_path} is not a valid .rm file: <header={header}><nlayers={nlayers}>"
-    )
+def parse_rm_file(file_path: str, source=None) -> Tuple[Tuple[TMetaData, bool], str]:
+    return ParsedPage.from_file(file_path, source).parse()
 
 # The line segment will pop up hundreds or thousands of times in notebooks where it is relevant.
 # this flag ensures it will print at most once.
@@ -3,6 +3,8 @@ from itertools import groupby
 
 import fitz
 
+from remarks.conversion.geometry import WordIndex
+
 
 # TODO: improve this check, it is still very rudimentary
 def check_if_text_extractable(page):
@@ -101,7 +103,12 @@ def get_page_text_tuples(
         return tuples_list
 
 
-def extract_groups_from_pdf_ann_hl(page, malformed=False):
+def get_page_word_index(page, sort=True):
+    """Index of all words on a PDF page, to look them up by annotation geometry"""
+    return WordIndex(get_page_text_tuples(page, sort=sort))
+
+
+def extract_groups_from_pdf_ann_hl(page, malformed=False, word_index=None):
     # https://pymupdf.readthedocs.io/en/latest/recipes-text.html#how-to-extract-text-from-within-a-rectangle
     # https://github.com/pymupdf/PyMuPDF-Utilities/tree/master/textbox-extraction
     # https://github.com/benlongo/remarkable-highlights/blob/0608dea6ba1f5ce46c540e623c55649f8f918b5c/remarkable_highlights/extract.py#L131
@@ -109,8 +116,11 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
     # If PDF is well-formed, no need for sorted words
     is_sort_needed = malformed
 
-    # Get all words (highlighted or not) from a PDF page
-    words_tuples_list = get_page_text_tuples(page, sort=is_sort_needed)
+    # Get all words (highlighted or not) from a PDF page, unless they are already indexed.
+    # When the PDF is malformed, the index must have been built from sorted words.
+    if word_index is None:
+        word_index = get_page_word_index(page, sort=is_sort_needed)
+    words_tuples_list = word_index.words
     # print("words_tuples_list:", words_tuples_list)
 
     # Get all rectangles of highlight annotations that exist on PDF page
@@ -128,10 +138,7 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
         # highlighted (or not)
         #
         # w[:4] for the bbbox coordinates of a word tuple: (x0, y0, x1, y1)
-        hl_words_mask = [
-            any([fitz.Rect(w[:4]).intersects(r) for r in hl_rects])
-            for w in words_tuples_list
-        ]
+        hl_words_mask = word_index.intersecting(hl_rects)
 
         # Join each sequence of consecutively highlighted words into a group
         curr_group = []
@@ -159,17 +166,12 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
         # limitations. For instance: (1) we won't "merge" highlighted words
         # that are separated by line breaks; (2) we might "merge" words that
         # are in the same line but were highlighted separately
-        hl_word_tuples = []
-        for word_tuple in words_tuples_list:
-            already_highlighted = False
-            for hl_rect in hl_rects:
-                if (
-                    fitz.Rect(word_tuple[:4]).intersects(hl_rect)
-                    and not already_highlighted
-                ):
-                    # print("hl_rect + word_tuple:", hl_rect, word_tuple)
-                    hl_word_tuples.append(word_tuple)
-                    already_highlighted = True
+        hl_words_mask = word_index.intersecting(hl_rects)
+        hl_word_tuples = [
+            word_tuple
+            for word_tuple, is_highlighted in zip(words_tuples_list, hl_words_mask)
+            if is_highlighted
+        ]
 
         # print("hl_word_tuples:", hl_word_tuples)
 
@@ -0,0 +1,272 @@
+import logging
+import multiprocessing
+import multiprocessing.forkserver
+import pathlib
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import sentry_sdk
+
+from remarks.output.PdfFile import PDF_SAVE_PROFILES, DEFAULT_PDF_SAVE_PROFILE
+from remarks.remarks import run_remarks, RemarksSummary
+from remarks.sources import ZipSource
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    in_path: pathlib.Path
+    out_dir: Optional[pathlib.Path]
+    """Where the output is written, None when it is sent back as an archive"""
+    future: Future = field(repr=False)
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    failed_documents: Dict[str, str] = field(default_factory=dict)
+    upload: Optional[pathlib.Path] = None
+    """The uploaded archive that is converted, deleted once the job is finished"""
+    archive_released: bool = False
+    """Whether the output archive was handed out or deleted, after which the queue doesn't touch it anymore"""
+
+    @property
+    def status(self) -> str:
+        if self.finished_at is None:
+            # A future already counts as running while it waits in the executor's call queue,
+            # the worker reports when it really starts the job
+            return "running" if self.started_at else "queued"
+        if self.error or self.failed_documents:
+            return "failed"
+        return "succeeded"
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "in_path": str(self.in_path),
+            "out_path": str(self.out_dir) if self.out_dir else None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "duration": (self.finished_at or time.time()) - self.started_at if self.started_at else None,
+            "error": self.error,
+            "failed": self.failed_documents,
+        }
+
+
+@dataclass
+class ConversionResult:
+    summary: RemarksSummary
+    started_at: float
+    finished_at: float
+    archive: Optional[pathlib.Path] = None
+    """A temporary zip archive with the output, for conversions of uploaded archives"""
+
+
+# In a conversion worker, where it reports the jobs it starts to the JobQueue
+_started_jobs: Optional[multiprocessing.SimpleQueue] = None
+
+
+def _init_worker(started_jobs: multiprocessing.SimpleQueue):
+    global _started_jobs
+    _started_jobs = started_jobs
+
+
+def _job_started(job_id: str) -> float:
+    started_at = time.time()
+    if _started_jobs is not None:
+        _started_jobs.put((job_id, started_at))
+    return started_at
+
+
+def _convert(job_id: str, in_path: pathlib.Path, out_dir: pathlib.Path, options: dict) -> ConversionResult:
+    """Runs in a conversion worker process"""
+    started_at = _job_started(job_id)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    summary = run_remarks(in_path, out_dir, **options)
+    return ConversionResult(summary, started_at, time.time())
+
+
+def _convert_archive(job_id: str, name: str, archive: pathlib.Path, options: dict) -> ConversionResult:
+    """Runs in a conversion worker process, the members of the uploaded archive are read without extracting it"""
+    started_at = _job_started(job_id)
+    with ZipSource(archive, pathlib.Path(name)) as source, tempfile.TemporaryDirectory() as out_dir:
+        summary = run_remarks(pathlib.Path(name), pathlib.Path(out_dir), source=source, **options)
+
+        output = tempfile.NamedTemporaryFile(prefix="remarks-output-", suffix=".zip", delete=False)
+        with output, zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+            for path in sorted(pathlib.Path(out_dir).rglob("*")):
+                if path.is_file():
+                    zip_ref.write(path, path.relative_to(out_dir))
+    return ConversionResult(summary, started_at, time.time(), pathlib.Path(output.name))
+
+
+def _result_archive(job: Job) -> Optional[pathlib.Path]:
+    try:
+        return job.future.result(timeout=0).archive
+    except BaseException:
+        return None
+
+
+class JobQueue:
+    """Runs conversions in a pool of worker processes, so they never block the web server.
+
+    At most `workers` conversions run at the same time, and at most `max_queued` more wait for a free worker.
+    Beyond that, `submit` raises QueueFull. The last `history` finished jobs are kept around to be queried.
+    Output archives of uploaded archives that aren't taken within `archive_ttl` seconds are deleted.
+    Output PDFs are saved with `pdf_profile`, see `PDF_SAVE_PROFILES`. With `low_memory`, documents are converted
+    in remarks' low memory mode."""
+
+    def __init__(self, workers: int = 2, max_queued: int = 16, history: int = 1000, archive_ttl: float = 600,
+                 pdf_profile: str = DEFAULT_PDF_SAVE_PROFILE, low_memory: bool = False):
+        if pdf_profile not in PDF_SAVE_PROFILES:
+            raise ValueError(f"Unknown PDF profile {pdf_profile}, expected one of {', '.join(PDF_SAVE_PROFILES)}")
+        self.workers = workers
+        self.max_queued = max_queued
+        self.history = history
+        self.archive_ttl = archive_ttl
+        # Passed on to run_remarks
+        self.options = {"pdf_profile": pdf_profile, "low_memory": low_memory}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._started_jobs: Optional[multiprocessing.SimpleQueue] = None
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the conversion workers ahead of the first job"""
+        with self._lock:
+            self._start()
+        multiprocessing.forkserver.ensure_running()
+
+    def _start(self) -> ProcessPoolExecutor:
+        # Created in the process that serves the requests rather than in a parent that forks it.
+        # Forking a process that serves requests on several threads isn't safe: the workers are forked from a
+        # fork server instead, a clean process that has loaded and warmed up remarks once.
+        if self._executor is None:
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["remarks.preload"])
+            if self._started_jobs is None:
+                # Workers report when they start a job, a job is only known to be finished from its future
+                self._started_jobs = context.SimpleQueue()
+                threading.Thread(target=self._record_started_jobs, name="remarks-job-starts", daemon=True).start()
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                 initializer=_init_worker, initargs=(self._started_jobs,))
+        return self._executor
+
+    def _record_started_jobs(self):
+        while True:
+            job_id, started_at = self._started_jobs.get()
+            job = self.get(job_id)
+            if job and job.started_at is None:
+                job.started_at = started_at
+
+    def _pending(self) -> int:
+        return sum(1 for job in self._jobs.values() if not job.future.done())
+
+    def submit(self, in_path: pathlib.Path, out_dir: pathlib.Path) -> Job:
+        """Convert a file or directory on disk, writing the output to out_dir"""
+        return self._submit(in_path, out_dir, None, _convert, in_path, out_dir, self.options)
+
+    def submit_archive(self, name: str, archive: pathlib.Path) -> Job:
+        """Convert an uploaded .rmn/.rmdoc archive, which is deleted once the job is finished.
+
+        The output is written to a temporary zip archive, see `take_archive`."""
+        return self._submit(pathlib.Path(name), None, archive, _convert_archive, name, archive, self.options)
+
+    def _submit(self, in_path: pathlib.Path, out_dir: Optional[pathlib.Path], upload: Optional[pathlib.Path],
+                fn, *args) -> Job:
+        with self._lock:
+            if self._pending() >= self.workers + self.max_queued:
+                raise QueueFull(f"{self._pending()} conversions are already queued or running")
+
+            job_id = str(uuid.uuid4())
+            executor = self._start()
+            try:
+                future = executor.submit(fn, job_id, *args)
+            except BrokenProcessPool:
+                # A worker died while the pool was idle, e.g. killed by the OOM killer. Start over with a new pool.
+                logging.warning("Conversion workers died, starting new ones")
+                self._executor = None
+                executor = self._start()
+                future = executor.submit(fn, job_id, *args)
+            job = Job(job_id, in_path, out_dir, future, upload=upload)
+            self._jobs[job.id] = job
+            self._forget_finished_jobs()
+            self._expire_archives()
+
+        job.future.add_done_callback(lambda future: self._finish(job, executor))
+        return job
+
+    def _finish(self, job: Job, executor: ProcessPoolExecutor):
+        if job.upload:
+            job.upload.unlink(missing_ok=True)
+        try:
+            result = job.future.result()
+            job.started_at, job.finished_at = result.started_at, result.finished_at
+            job.failed_documents = result.summary.failed
+            if result.summary.failed:
+                logging.error(f"Job {job.id} failed: {result.summary.failed}")
+                # Incomplete output is never handed out
+                with self._lock:
+                    self._delete_archive(job)
+        except BaseException as e:
+            # Includes the worker dying, and remarks exiting on an input without documents
+            job.finished_at = time.time()
+            job.error = f"{type(e).__name__}: {e}"
+            logging.error(f"Job {job.id} failed: {job.error}")
+            sentry_sdk.capture_exception(e)
+            if isinstance(e, BrokenProcessPool):
+                # A worker died, e.g. killed by the OOM killer. The pool is unusable now, start a new one next time.
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+        with self._lock:
+            self._expire_archives()
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.future.done()]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            self._delete_archive(self._jobs.pop(job_id))
+
+    def _expire_archives(self):
+        expired_before = time.time() - self.archive_ttl
+        for job in self._jobs.values():
+            if job.finished_at and job.finished_at < expired_before:
+                self._delete_archive(job)
+
+    def _delete_archive(self, job: Job):
+        if not job.archive_released:
+            job.archive_released = True
+            archive = _result_archive(job)
+            if archive:
+                archive.unlink(missing_ok=True)
+
+    def take_archive(self, job: Job) -> Optional[pathlib.Path]:
+        """The output archive of a finished job, once. The caller deletes it when it is done with it.
+
+        None when the job isn't finished, or its archive was taken, expired or the job failed."""
+        with self._lock:
+            if job.archive_released or not job.future.done():
+                return None
+            job.archive_released = True
+            return _result_archive(job)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> list:
+        with self._lock:
+            return list(self._jobs.values())
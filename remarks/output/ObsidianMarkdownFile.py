@@ -3,11 +3,27 @@ import time
 from typing import List, Dict
 
 import yaml
-from jinja2 import Environment, FileSystemLoader
-from rmscene.scene_items import GlyphRange, ParagraphStyle
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+from rmscene.scene_items import GlyphRange, ParagraphStyle, PenColor
 from rmscene.text import Paragraph
 
 from remarks.Document import Document
+from remarks.conversion.parsing import Highlight
+
+_obsidian_markdown_template = None
+
+
+def obsidian_markdown_template() -> Template:
+    """The markdown template, compiled once per process and shared by every document.
+
+    The compiled bytecode is cached on disk as well, so new processes don't compile it again either."""
+    global _obsidian_markdown_template
+    if _obsidian_markdown_template is None:
+        env = Environment(loader=FileSystemLoader(pathlib.Path(__file__).parent),
+                          bytecode_cache=FileSystemBytecodeCache())
+        _obsidian_markdown_template = env.get_template('obsidian_markdown.md.jinja')
+    return _obsidian_markdown_template
+
 
 def render_paragraph(paragraph: Paragraph):
     paragraph_content = ""
@@ -39,7 +55,8 @@ class RMPage:
     def __init__(self):
         self.highlights: List[GlyphRange] = []
         self.tags: List[str] = []
-        self.text: None | list[Paragraph] = None
+        # The markdown of every paragraph of typed text
+        self.text: None | list[str] = None
 
 
 def merge_highlight_texts(h1: GlyphRange, h2: GlyphRange, distance: int) -> str:
@@ -92,56 +109,39 @@ def calculate_highlight_distance(h1: GlyphRange, h2: GlyphRange):
 
 def merge_highlights(highlights: List[GlyphRange]):
     max_gap_threshold = 3
-    merged_highlights = list(filter(lambda h: h is not None and type(h.start) is int, highlights.copy()))
-    # Continue until no more changes
-    while True:
-        # Sort by starting position
-        merged_highlights.sort(key=lambda h: h.start)
-
-        # Flag to track if any merges happened
-        merged_any = False
-
-        # Check all pairs for possible merges
-        i = 0
-        while i < len(merged_highlights) - 1:
-            j = i + 1
-            while j < len(merged_highlights):
-                h1 = merged_highlights[i]
-                h2 = merged_highlights[j]
-
-                # Calculate distance (ensuring A comes before B)
-                distance, end_of_h1, h1, h2 = calculate_highlight_distance(h1, h2)
-
-                # If they should be merged
-                if distance <= max_gap_threshold:
-                    # Create merged highlight
-                    new_start = min(h1.start, h2.start)
-                    new_end = max(end_of_h1, h2.start + h2.length)
-                    new_length = new_end - new_start
-
-                    # Create new highlight
-                    merged_highlight = GlyphRange(
-                        start=new_start,
-                        length=new_length,
-                        text=merge_highlight_texts(h1, h2, distance),
-                        color=h1.color,
-                        rectangles=h1.rectangles + h2.rectangles
-                    )
-
-                    # Replace A with merged highlight and remove B
-                    merged_highlights[i] = merged_highlight
-                    merged_highlights.pop(j)
-
-                    merged_any = True
-                    # Don't increment j since we removed an element
-                else:
-                    j += 1
-
-            i += 1
-
-        # If no merges happened, we're done
-        if not merged_any:
-            break
+    sorted_highlights = sorted(filter(lambda h: h is not None and type(h.start) is int, highlights),
+                               key=lambda h: h.start)
+
+    merged_highlights = []
+    # Highlights are only merged with highlights of the same color. Going through them by starting position,
+    # a highlight that is too far from the last one of its color also is from every earlier one,
+    # so only the last highlight of each color can still grow.
+    open_highlights: Dict[PenColor, int] = {}
+    for highlight in sorted_highlights:
+        i = open_highlights.get(highlight.color)
+        if i is not None:
+            # Calculate distance (ensuring A comes before B)
+            distance, end_of_h1, h1, h2 = calculate_highlight_distance(merged_highlights[i], highlight)
+
+            # If they should be merged
+            if distance <= max_gap_threshold:
+                # Create merged highlight
+                new_start = min(h1.start, h2.start)
+                new_end = max(end_of_h1, h2.start + h2.length)
+                new_length = new_end - new_start
+
+                # Replace A with the merged highlight
+                merged_highlights[i] = GlyphRange(
+                    start=new_start,
+                    length=new_length,
+                    text=merge_highlight_texts(h1, h2, distance),
+                    color=h1.color,
+                    rectangles=h1.rectangles + h2.rectangles
+                )
+                continue
+
+        open_highlights[highlight.color] = len(merged_highlights)
+        merged_highlights.append(highlight)
     return merged_highlights
 
 
@@ -164,32 +164,30 @@ class ObsidianMarkdownFile:
         if self.document.rm_tags:
             frontmatter["tags"] = [f"#remarkable/{tag}" for tag in self.document.rm_tags]
 
-        env = Environment(loader=FileSystemLoader(pathlib.Path(__file__).parent))
-        template = env.get_template('obsidian_markdown.md.jinja')
-
-        content = template.render(**{
+        content = obsidian_markdown_template().stream(**{
             'document': self.document,
             'frontmatter': yaml.dump(frontmatter, indent=3, width=360),
             'pages': self.pages,
             'sorted_pages': sorted(self.pages.items()),
-            'render_paragraph': render_paragraph
         })
 
         with open(f"{location} _obsidian.md", "w") as f:
-            f.write(content)
+            content.dump(f)
 
     def add_highlights(
-        self, page_idx: int, highlights: List[GlyphRange]
+        self, page_idx: int, highlights: List[Highlight]
     ):
         if not highlights:
             return
 
-        self.retrieve_page(page_idx).highlights = merge_highlights(highlights)
+        self.retrieve_page(page_idx).highlights = merge_highlights(
+            [highlight.to_glyph_range() for highlight in highlights])
 
     def add_text(self, page_idx: int, text):
         if not text:
             return
-        self.retrieve_page(page_idx).text = text["text"].contents
+        # Rendered right away, rather than keeping the paragraphs and with them the page's scene tree alive
+        self.retrieve_page(page_idx).text = [render_paragraph(paragraph) for paragraph in text["text"].contents]
 
     def add_page_tags(self, page_idx: int, tags: List[str]):
         if not tags:
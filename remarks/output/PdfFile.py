@@ -1,13 +1,68 @@
 # TODO: Refactor into standalone file that handles
 #       all PDF rendering logic
 
+import io
+import os
+import tempfile
+import time
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+
 import fitz
 import logging
+import numpy as np
 from fitz import Page, Rect, Annot, Quad
+from rmc.exporters.pdf import svg_to_pdf
+from rmc.exporters.svg import tree_to_svg
+from rmscene import SceneTree
 
-from remarks.conversion.parsing import RemarksRectangle
+from remarks.conversion.geometry import WordIndex
+from remarks.conversion.parsing import Highlight
 from remarks.warnings import scrybble_warning_typed_text_highlighting_not_supported
-from rmscene.scene_items import PenColor, HARDCODED_COLORMAP
+from rmscene.scene_items import HARDCODED_COLORMAP
+
+
+def write_annotation_layer_pdf(scene_tree: SceneTree, pdf_path) -> None:
+    """Render an already parsed scene tree to a PDF file.
+
+    This is what rmc's `rm_to_pdf` does, minus reading and decoding the .rm file all over again."""
+    svg = io.StringIO()
+    tree_to_svg(scene_tree, svg)
+    svg.seek(0)
+    with open(pdf_path, "wb") as pdf_file:
+        svg_to_pdf(svg, pdf_file)
+
+
+def render_annotation_layer(scene_tree: SceneTree, in_memory: bool = False) -> fitz.Document:
+    """Render an already parsed scene tree to a single-page PDF document.
+
+    Both ways go through rmc's `svg_to_pdf`, exactly like `rm_to_pdf`. By default, the PDF is written to a
+    temporary file. With `in_memory`, it is written to a buffer instead, without touching the filesystem."""
+    if in_memory:
+        svg = io.StringIO()
+        tree_to_svg(scene_tree, svg)
+        svg.seek(0)
+        pdf_file = io.BytesIO()
+        svg_to_pdf(svg, pdf_file)
+        return fitz.open(stream=pdf_file.getvalue(), filetype="pdf")
+
+    temp_pdf = tempfile.NamedTemporaryFile(suffix=".pdf", mode="w", delete=False)
+    try:
+        write_annotation_layer_pdf(scene_tree, temp_pdf.name)
+        return fitz.open(temp_pdf.name)
+    finally:
+        temp_pdf.close()
+        os.remove(temp_pdf.name)
+
+
+# Used for colors that aren't in the colormap
+FALLBACK_HIGHLIGHT_COLOR = (255 / 255, 237 / 255, 117 / 255)
+
+# PenColor to RGB, normalized to the 0-1 range PyMuPDF expects. The alpha channel is ignored.
+HIGHLIGHT_COLORS: Mapping[int, Tuple[float, float, float]] = MappingProxyType({
+    pen_color: (r / 255, g / 255, b / 255)
+    for (r, g, b, _), pen_color in HARDCODED_COLORMAP.items()
+})
 
 
 def get_highlight_color(pen_color: int) -> tuple[float, float, float]:
@@ -19,41 +74,112 @@ def get_highlight_color(pen_color: int) -> tuple[float, float, float]:
     Returns:
         RGB tuple with values normalized to 0-1 range for PyMuPDF
     """
-    # Create reverse mapping from PenColor to RGBA
-    color_to_rgba = {v: k for k, v in HARDCODED_COLORMAP.items()}
-    
-    # Try to convert to PenColor enum, fall back to raw integer lookup
-    try:
-        pen_color_enum = PenColor(pen_color)
-        rgba = color_to_rgba.get(pen_color_enum, (255, 237, 117, 255))
-    except ValueError:
-        # If the color value is not a valid PenColor enum, use fallback
-        rgba = (255, 237, 117, 255)
-    
-    # Convert to RGB (ignore alpha) and normalize to 0-1 range
-    r, g, b, _ = rgba
-    return (r / 255, g / 255, b / 255)
-
-
-def apply_smart_highlight(page: Page, highlight: RemarksRectangle, x_translation: float) -> None:
-    # Get the color for this highlight based on its PenColor value
+    # PenColor is an IntEnum, plain integers find their color too
+    return HIGHLIGHT_COLORS.get(pen_color, FALLBACK_HIGHLIGHT_COLOR)
+
+
+def replace_pages(document: fitz.Document, replacements: fitz.Document, page_numbers: Dict[int, int]) -> None:
+    """Replace pages of `document` with pages of `replacements`, in one pass over the page tree.
+
+    `page_numbers` maps a page index in `document` to the index of its replacement page in `replacements`.
+    All replacements are appended with a single `insert_pdf`, after which `select` puts every page in its final
+    position. The document itself is kept, so its metadata and outline survive."""
+    if not page_numbers:
+        return
+
+    page_count = document.page_count
+    document.insert_pdf(replacements)
+    document.select([
+        page_count + page_numbers[page_idx] if page_idx in page_numbers else page_idx
+        for page_idx in range(page_count)
+    ])
+
+
+# Keyword arguments of `fitz.Document.save` for every output PDF profile
+PDF_SAVE_PROFILES: Mapping[str, Mapping] = MappingProxyType({
+    # The baseline: save's defaults, how output PDFs were always saved. It isn't tuned to save faster, it only
+    # skips the work "compact" does.
+    "fast": MappingProxyType({}),
+    # Drops unused objects, merges duplicate objects and streams such as the fonts every merged page brings along,
+    # compresses all streams and packs objects into object streams. Slower to save, much smaller to serve.
+    "compact": MappingProxyType({
+        "garbage": 4, "clean": True, "deflate": True, "deflate_images": True, "deflate_fonts": True,
+        "use_objstms": True,
+    }),
+})
+DEFAULT_PDF_SAVE_PROFILE = "fast"
+
+
+def save_pdf(document: fitz.Document, path, profile: str = DEFAULT_PDF_SAVE_PROFILE) -> None:
+    start = time.perf_counter()
+    document.save(path, **PDF_SAVE_PROFILES[profile])
+    logging.info(f"Saved {path} with the {profile} profile in {time.perf_counter() - start:.2f} s, "
+                 f"{os.path.getsize(path) / 1024:.0f} KiB")
+
+
+def highlight_rects(highlight: Highlight, x_translation: float) -> List[Rect]:
+    """The rectangles of a highlight on its PDF page"""
+    # Highlight rectangles are already in PDF coordinate space via xx/yy transformation
+    # x_translation positions them correctly relative to reMarkable's (0,0) at center-top of PDF
+    x, y, w, h = highlight.boxes.T
+    x0 = x + x_translation
+    return [Rect(rect) for rect in np.column_stack([x0, y, x0 + w, y + h]).tolist()]
+
+
+def apply_smart_highlight(page: Page, highlight: Highlight, x_translation: float,
+                          combined: bool = False) -> None:
+    # Get the color for this highlight based on its PenColor value, once for all of its rectangles
     highlight_color = get_highlight_color(highlight.color)
+    rects = highlight_rects(highlight, x_translation)
 
-    for rectangle in highlight.rectangles:
-        x, y, w, h = rectangle.x, rectangle.y, rectangle.w, rectangle.h
-        # Highlight rectangles are already in PDF coordinate space via xx/yy transformation
-        # x_translation positions them correctly relative to reMarkable's (0,0) at center-top of PDF
-        rect = Rect((x + x_translation, y), (x + x_translation + w, y + h))
+    if combined and rects:
+        # A single annotation holding every line of the highlight, its appearance is only generated once
         try:
-            annot: Annot = page.add_highlight_annot(quads=rect)
-            # Use the dynamic color based on the highlight's actual color from the reMarkable file
-            annot.set_colors(stroke=highlight_color)
-            annot.set_opacity(0.3)
-            annot.update()
+            add_highlight_annot(page, coalesce_line_rects(rects), highlight_color)
+            return
+        except ValueError:
+            # One of the rectangles is bad, fall back to an annotation per rectangle to keep the others
+            pass
+
+    for rect in rects:
+        try:
+            add_highlight_annot(page, rect, highlight_color)
         except ValueError:
             logging.warning(f"Bad quads entry {rect}")
 
 
+def add_highlight_annot(page: Page, quads, highlight_color: Tuple[float, float, float]) -> Annot:
+    annot: Annot = page.add_highlight_annot(quads=quads)
+    # Use the dynamic color based on the highlight's actual color from the reMarkable file
+    annot.set_colors(stroke=highlight_color)
+    annot.set_opacity(0.3)
+    annot.update()
+    return annot
+
+
+def coalesce_line_rects(rects: List[Rect], tolerance: float = 1.0) -> List[Rect]:
+    """Join rectangles that touch or overlap on the same line into one.
+
+    Rectangles are on the same line when their tops and bottoms are within `tolerance` of each other,
+    and touch when the gap between them is at most `tolerance`."""
+    lines: List[List[Rect]] = []
+    for rect in sorted(rects, key=lambda r: (r.y0, r.x0)):
+        if lines and abs(lines[-1][0].y0 - rect.y0) <= tolerance and abs(lines[-1][0].y1 - rect.y1) <= tolerance:
+            lines[-1].append(rect)
+        else:
+            lines.append([rect])
+
+    coalesced: List[Rect] = []
+    for line in lines:
+        start = len(coalesced)
+        for rect in sorted(line, key=lambda r: r.x0):
+            if len(coalesced) > start and rect.x0 <= coalesced[-1].x1 + tolerance:
+                coalesced[-1] = coalesced[-1] | rect
+            else:
+                coalesced.append(Rect(rect))
+    return coalesced
+
+
 def add_error_annotation(page: Page, more_info=""):
     page.add_text_annot(
         text="Scrybble error" + more_info,
@@ -85,25 +211,28 @@ def check_contain(r_word, points):
     return r.get_area() >= r_word.get_area() * 0.5
 
 
-def extract_annot(annot, words_on_page):
+def extract_annot(annot, words_on_page, word_index: Optional[WordIndex] = None):
     """Extract words in a given highlight.
 
     Args:
         annot (fitz.Annot): [description]
         words_on_page (list): [description]
+        word_index (WordIndex): index of `words_on_page`, build it once and pass it along
+            when extracting every annotation on a page.
 
     Returns:
         str: words in the entire highlight.
     """
+    if word_index is None:
+        word_index = WordIndex(words_on_page)
+
     quad_points = annot.vertices
     quad_count = int(len(quad_points) / 4)
     sentences = ['' for i in range(quad_count)]
     for i in range(quad_count):
         points = quad_points[i * 4: i * 4 + 4]
-        words = [
-            w for w in words_on_page if
-            check_contain(Rect(w[:4]), points)
-        ]
+        # The same test as check_contain, only for the words near the quad
+        words = word_index.contained(Quad(points).rect)
         sentences[i] = ' '.join(w[4] for w in words)
     sentence = ' '.join(sentences)
 
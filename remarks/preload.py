@@ -0,0 +1,35 @@
+"""Loads and warms up everything a conversion needs.
+
+Importing this module imports PyMuPDF, rmscene and rmc, compiles the markdown template and renders a tiny page, so
+that the first real conversion doesn't pay for it. The conversion workers of the server are forked from a process
+that imported it, and share all of this copy-on-write."""
+import io
+import logging
+import time
+
+from rmscene import simple_text_document, write_blocks
+
+from remarks.conversion.parsing import ParsedPage
+from remarks.dimensions import REMARKABLE_DOCUMENT
+from remarks.output.ObsidianMarkdownFile import obsidian_markdown_template
+from remarks.remarks import PageGeometry, render_page
+
+
+def warm_up():
+    start = time.perf_counter()
+    obsidian_markdown_template()
+
+    rm_file = io.BytesIO()
+    write_blocks(rm_file, simple_text_document("remarks"))
+    dimensions = REMARKABLE_DOCUMENT.to_mm().to_mu()
+    geometry = PageGeometry(dimensions.width, dimensions.height, 0, False)
+    render_page(ParsedPage("warm-up.rm", rm_file.getvalue()), geometry, device="RMPP")
+
+    logging.info(f"Warmed up in {time.perf_counter() - start:.2f} s")
+
+
+# A failed warm-up only makes the first conversion slower, it mustn't keep the conversion workers from starting
+try:
+    warm_up()
+except Exception as e:
+    logging.warning(f"Warming up failed, the first conversion will be slower: {e!r}")
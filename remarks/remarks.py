@@ -2,11 +2,14 @@ import logging
 import os
 import pathlib
 import sys
-import tempfile
-import zipfile
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
 
 import fitz  # PyMuPDF
-from rmc.exporters.pdf import rm_to_pdf
 import rmc.exporters.svg as svg_exporter
 from rmc.exporters.svg import build_anchor_pos, get_bounding_box, set_device, set_dimensions_for_pdf, rmc_config
 from rmc.exporters.svg import rm_to_svg
@@ -14,33 +17,58 @@ from rmc.exporters.svg import rm_to_svg
 import rmc
 
 from .Document import Document
-from .conversion.parsing import (
-    parse_rm_file,
-    read_rm_file_version, )
+from .sources import InputSource, ZipSource, is_archive
+from .cache import DocumentCache, RenderCache
+from .conversion.parsing import ParsedPage, TMetaData
 from .metadata import ReMarkableAnnotationsFileHeaderVersion
 from .output.ObsidianMarkdownFile import ObsidianMarkdownFile
-from .output.PdfFile import apply_smart_highlight, add_error_annotation
+from .output.PdfFile import apply_smart_highlight, add_error_annotation, render_annotation_layer, \
+    replace_pages, save_pdf, DEFAULT_PDF_SAVE_PROFILE
 from .utils import (
     is_document,
     get_document_filetype,
     get_visible_name,
     get_ui_path,
+    MetadataStore,
 )
 from .warnings import scrybble_warning_only_v6_supported
 
 
 
+@dataclass
+class RemarksSummary:
+    """The outcome of a `run_remarks` invocation, per document"""
+    converted: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+    """Maps the document to the error that made it fail"""
+
+
 def run_remarks(
         input_dir: pathlib.Path, output_dir: pathlib.Path,
-        device: str = None
-):
-    if input_dir.name.endswith(".rmn") or input_dir.name.endswith(".rmdoc"):
-        temp_dir = tempfile.mkdtemp()
-        with zipfile.ZipFile(input_dir, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        input_dir = pathlib.Path(temp_dir)
-
-    num_docs = sum(1 for _ in input_dir.glob("*.metadata"))
+        device: str = None,
+        in_memory: bool = False,
+        workers: int = 1,
+        page_workers: int = 1,
+        incremental: bool = False,
+        render_cache: Optional[RenderCache] = None,
+        source: Optional[InputSource] = None,
+        combined_highlights: bool = False,
+        pdf_profile: str = DEFAULT_PDF_SAVE_PROFILE,
+        low_memory: bool = False
+) -> RemarksSummary:
+    if source is None and is_archive(input_dir):
+        # Members are read straight from the archive, nothing is extracted
+        with ZipSource(input_dir) as source:
+            return run_remarks(input_dir, output_dir, device=device, in_memory=in_memory, workers=workers,
+                               page_workers=page_workers, incremental=incremental, render_cache=render_cache,
+                               source=source, combined_highlights=combined_highlights,
+                               pdf_profile=pdf_profile, low_memory=low_memory)
+
+    # Every .metadata and .content file is read once for the whole run
+    store = MetadataStore(input_dir, source)
+    metadata_paths = store.source.glob(input_dir, "*.metadata")
+    num_docs = len(metadata_paths)
 
     if num_docs == 0:
         logging.warning(
@@ -52,45 +80,157 @@ def run_remarks(
         f'\nFound {num_docs} documents in "{input_dir}", will process them now',
     )
 
-    for metadata_path in input_dir.glob("*.metadata"):
-        if not is_document(metadata_path):
+    summary = RemarksSummary()
+    documents = []
+
+    for metadata_path in metadata_paths:
+        if not is_document(metadata_path, store=store):
             continue
 
-        doc_type = get_document_filetype(metadata_path)
+        doc_type = get_document_filetype(metadata_path, store=store)
         # Both "Quick Sheets" and "Notebooks" have doc_type="notebook"
         supported_types = ["pdf", "epub", "notebook"]
 
-        doc_name = get_visible_name(metadata_path)
+        doc_name = get_visible_name(metadata_path, store=store)
 
         if not doc_name:
             continue
 
         if doc_type in supported_types:
-            logging.info(f'\nFile: "{doc_name} [type={doc_type}]" ({metadata_path.stem})')
-
-            in_device_dir = get_ui_path(metadata_path)
+            in_device_dir = get_ui_path(metadata_path, store=store)
             relative_doc_path = pathlib.Path(f"{in_device_dir}/{doc_name}")
+            description = f'"{doc_name} [type={doc_type}]" ({metadata_path.stem})'
 
-            process_document(metadata_path, relative_doc_path, output_dir,
-                             device=device)
+            documents.append((metadata_path, relative_doc_path, description))
         else:
             logging.info(
                 f'\nFile skipped: "{doc_name}" ({metadata_path.stem}) due to unsupported filetype: {doc_type}. remarks only supports: {", ".join(supported_types)}'
             )
+            summary.skipped.append(str(metadata_path.stem))
+
+    options = {"device": device, "in_memory": in_memory, "page_workers": page_workers, "incremental": incremental,
+               "render_cache": render_cache, "combined_highlights": combined_highlights,
+               "pdf_profile": pdf_profile, "low_memory": low_memory}
+
+    if workers == 0:
+        workers = os.cpu_count()
+
+    if workers > 1 and len(documents) > 1:
+        # Documents are converted in separate processes, rmc's page settings are module-global state
+        log_level = logging.getLogger().getEffectiveLevel()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_process_document_job, metadata_path, relative_doc_path, output_dir, description,
+                                log_level, {**options, "store": store.subset([metadata_path.stem])}): relative_doc_path
+                for metadata_path, relative_doc_path, description in documents
+            }
+            for future in as_completed(futures):
+                relative_doc_path = futures[future]
+                try:
+                    log_records, converted, error = future.result()
+                except Exception as e:
+                    # The worker itself died, e.g. killed by the OOM killer
+                    log_records, converted = [(logging.ERROR, f'Failed to process "{relative_doc_path}": {e}')], False
+                    error = repr(e)
+                # Replay the document's log messages together, so they don't interleave with other documents
+                for level, message in log_records:
+                    logging.log(level, message)
+                _record_result(summary, relative_doc_path, converted, error)
+    else:
+        for metadata_path, relative_doc_path, description in documents:
+            converted, error = _process_document_safely(metadata_path, relative_doc_path, output_dir, description,
+                                                        {**options, "store": store})
+            _record_result(summary, relative_doc_path, converted, error)
 
     logging.info(
-        f'\nDone processing "{input_dir}"',
+        f'\nDone processing "{input_dir}": {len(summary.converted)} converted, {len(summary.failed)} failed, '
+        f'{len(summary.skipped)} skipped',
     )
 
+    return summary
+
+
+def _record_result(summary: RemarksSummary, relative_doc_path: pathlib.Path, converted: bool, error: Optional[str]):
+    if error is not None:
+        summary.failed[str(relative_doc_path)] = error
+    elif converted:
+        summary.converted.append(str(relative_doc_path))
+    else:
+        summary.skipped.append(str(relative_doc_path))
+
+
+def _process_document_safely(metadata_path, relative_doc_path, output_dir, description,
+                             options) -> Tuple[bool, Optional[str]]:
+    """Process one document, returning whether it was converted and the error that made it fail instead of raising it"""
+    logging.info(f'\nFile: {description}')
+    try:
+        return process_document(metadata_path, relative_doc_path, output_dir, **options), None
+    except Exception as e:
+        logging.exception(f'Failed to process "{relative_doc_path}"')
+        return False, f"{type(e).__name__}: {e}"
+
+
+class _LogCollector(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records: List[Tuple[int, str]] = []
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append((record.levelno, self.format(record)))
+
+
+@contextmanager
+def _collect_logs(log_level):
+    """Collect log messages instead of printing them, so a worker process can hand them to its parent"""
+    root_logger = logging.getLogger()
+    collector = _LogCollector()
+    handlers = root_logger.handlers[:]
+    root_logger.handlers = [collector]
+    root_logger.setLevel(log_level)
+    try:
+        yield collector.records
+    finally:
+        root_logger.handlers = handlers
+
+
+def _process_document_job(metadata_path, relative_doc_path, output_dir, description, log_level, options):
+    """Entry point for a document worker process"""
+    with _collect_logs(log_level) as log_records:
+        converted, error = _process_document_safely(metadata_path, relative_doc_path, output_dir, description,
+                                                    options)
+    return log_records, converted, error
+
 
 def process_document(
         metadata_path: pathlib.Path,
         relative_doc_path: pathlib.Path,
         output_dir: pathlib.Path,
-        device: str = None
-):
+        device: str = None,
+        in_memory: bool = False,
+        page_workers: int = 1,
+        incremental: bool = False,
+        render_cache: Optional[RenderCache] = None,
+        store: Optional[MetadataStore] = None,
+        combined_highlights: bool = False,
+        pdf_profile: str = DEFAULT_PDF_SAVE_PROFILE,
+        low_memory: bool = False
+) -> bool:
+    """Convert one document, returns False when it was skipped because it didn't change since the last conversion"""
+    document = Document(metadata_path, store)
+
+    output_pdf_path = output_dir/f"{relative_doc_path} _remarks.pdf"
+    output_obsidian_path = output_dir/f"{relative_doc_path}"
+
+    cache = None
+    if incremental:
+        cache = DocumentCache(output_dir, document,
+                              {"device": device, "in_memory": in_memory, "combined_highlights": combined_highlights,
+                               "pdf_profile": pdf_profile, "low_memory": low_memory},
+                              [output_pdf_path, output_dir/f"{relative_doc_path} _obsidian.md"])
+        if cache.is_unchanged():
+            logging.info("Unchanged since the last conversion, skipping")
+            return False
 
-    document = Document(metadata_path)
     rmc_pdf_src = document.open_source_pdf()
 
     obsidian_markdown = ObsidianMarkdownFile(document)
@@ -101,124 +241,315 @@ def process_document(
         if page_tags:
             obsidian_markdown.add_page_tags(page_idx, page_tags)
 
-    for (
-            page_uuid,
-            page_idx,
-            rm_annotation_file,
-    ) in document.pages():
-        logging.info(f"processing page {page_idx + 1}, {page_uuid}")
+    render_times = []
+    render_cache_hits = 0
+    # Finished pages are collected here and swapped into the source document in a single pass at the end,
+    # rather than editing its page tree twice for every annotated page
+    composed_pages = fitz.open()
+    replaced_pages = {}
+    pending_highlights = []
+    # Pages rendered during this run, which are stored in the cache once they are finished
+    rendered_pages = {}
+
+    def add_to_markdown(page_idx, ann_data):
+        if ann_data:
+            if "text" in ann_data:
+                obsidian_markdown.add_text(page_idx, ann_data['text'])
+            if "highlights" in ann_data:
+                obsidian_markdown.add_highlights(page_idx, ann_data["highlights"])
+
+    def finish_page(page_idx, page_uuid, geometry, rendered: RenderedPage):
         page = rmc_pdf_src[page_idx]
+        ann_data = rendered.annotations
 
-        rm_file_version = read_rm_file_version(rm_annotation_file)
-
-        if rm_file_version == ReMarkableAnnotationsFileHeaderVersion.V6:
-            # Get PDF page dimensions BEFORE parsing to ensure correct SCALE is used
-            page_rotation = page.rotation
-            page.set_rotation(0)
-            w_bg, h_bg = page.cropbox.width, page.cropbox.height
-            if int(page_rotation) in [90, 270]:
-                w_bg, h_bg = h_bg, w_bg
-            page.set_rotation(page_rotation)  # Restore rotation
-
-            # Set SVG dimensions: use PDF dimensions if there's backing content,
-            # otherwise use device setting for notebooks
-            has_backing_pdf = page.get_contents()
-            if has_backing_pdf:
-                logging.info(f"Setting page dimensions based on pdf: {round(w_bg,2)} x {round(h_bg,2)}")
-                set_dimensions_for_pdf(w_bg, h_bg)
-            elif device:
-                logging.info(f"Setting page dimensions based on device: {device}")
-                set_device(device)
+        # This offset is used for smart highlights
+        highlights_x_translation = 0
+        if rendered.failed:
+            add_error_annotation(page)
+        else:
+            if rendered.from_render_cache:
+                nonlocal render_cache_hits
+                render_cache_hits += 1
             else:
-                logging.warning(f"Unknown device and no backing pdf: setting page size to RMPP (if this is incorrect, specify device with --device)")
-                set_device('RMPP')
-
-            (ann_data, has_ann_hl), version = parse_rm_file(rm_annotation_file)
-            temp_pdf = tempfile.NamedTemporaryFile(suffix=".pdf", mode="w", delete=False)
-
-            # This offset is used for smart highlights
-            highlights_x_translation = 0
+                render_times.append(rendered.render_time)
             try:
-
-                # convert the pdf
-                rm_to_pdf(rm_annotation_file, temp_pdf.name)
-
-                svg_pdf = fitz.open(temp_pdf.name)
-
-                # if the background page is not empty, need to merge svg on top of background page
-                if has_backing_pdf:
-                    # w_bg, h_bg already calculated above
-                    # find the (top, right) coordinates of the svg
-                    anchor_pos = build_anchor_pos(ann_data["scene_tree"].root_text)
-                    # Convert PDF dimensions to screen coordinates for bounding box default
-                    # PDF uses points (72 DPI), screen uses device DPI; SCALE = 72/DPI
-                    # reMarkable uses center-top origin: x from -w/2 to w/2, y from 0 to h
-                    w_bg_screen = w_bg / rmc_config.scale
-                    h_bg_screen = h_bg / rmc_config.scale
-                    pdf_default_bounds = (-w_bg_screen / 2, w_bg_screen / 2, 0, h_bg_screen)
-                    x_min, x_max, y_min, y_max = get_bounding_box(
-                        ann_data["scene_tree"].root, anchor_pos, default=pdf_default_bounds
-                    )
-                    x_shift, y_shift, w_svg, h_svg = rmc_config.xx(x_min), rmc_config.yy(y_min), rmc_config.xx(x_max - x_min + 1), rmc_config.yy(y_max - y_min + 1)
-
-                    # compute the width/height of a blank page that can contain both svg and background pdf
-                    width, height = max(w_svg, w_bg), max(h_svg, h_bg)
-                    # compute position of svg and background in the new_page
-                    # reMarkable (0,0) is at center-top of PDF page
-                    # SVG coordinates need to be positioned relative to this center-top origin
-                    x_svg, y_svg = 0, 0
-                    x_bg, y_bg = 0, 0
-
-                    if w_svg > w_bg:
-                        x_bg = width / 2 - w_bg / 2 - (w_svg / 2 + x_shift)
-                        # Highlights need to account for reMarkable's center-top origin: PDF center = w_bg/2
-                        highlights_x_translation = x_bg + w_bg / 2
-                    elif w_svg < w_bg:
-                        x_svg = width / 2 - w_svg / 2 + (w_svg / 2 + x_shift)
-                        # When SVG is smaller, PDF spans full width, so center is at w_bg/2
-                        highlights_x_translation = w_bg / 2
-                    if h_svg > h_bg:
-                        y_bg = - y_shift
-                    elif h_svg < h_bg:
-                        y_svg = y_shift
-
-                    # create the merged page in independent document as show_pdf_page can't be done on the same document
-                    doc = fitz.open()
-                    page = doc.new_page(-1,
-                                        width=width,
-                                        height=height)
-                    page.show_pdf_page(fitz.Rect(x_bg, y_bg, x_bg + w_bg, y_bg + h_bg),
-                                        rmc_pdf_src,
-                                        page_idx,
-                                       rotate=-page_rotation)
-                    page.show_pdf_page(fitz.Rect(x_svg, y_svg, x_svg + w_svg, y_svg + h_svg),
-                                        svg_pdf,
-                                        0)
-
-                    rmc_pdf_src.insert_pdf(doc, start_at=page_idx)
-                else:
-                    rmc_pdf_src.insert_pdf(svg_pdf, start_at=page_idx)
-                rmc_pdf_src.delete_page(page_idx + 1)
+                highlights_x_translation = compose_page(rmc_pdf_src, page_idx, geometry, rendered,
+                                                        composed_pages, replaced_pages)
+                rendered_pages[page_idx] = page_uuid
             except AttributeError:
+                if page_idx in replaced_pages:
+                    composed_pages.delete_page(replaced_pages.pop(page_idx))
                 add_error_annotation(page)
-            finally:
-                temp_pdf.close()
-                os.remove(temp_pdf.name)
-
-            if ann_data:
-                if "text" in ann_data:
-                    obsidian_markdown.add_text(page_idx, ann_data['text'])
-                if "glyph_ranges" in ann_data:
-                    obsidian_markdown.add_highlights(page_idx, ann_data["glyph_ranges"])
-                if ann_data["highlights"]:
-                    for highlight in ann_data["highlights"]:
-                        apply_smart_highlight(rmc_pdf_src[page_idx], highlight, highlights_x_translation)
-        else:
-            scrybble_warning_only_v6_supported.render_as_annotation(page)
 
-    output_pdf_path = output_dir/f"{relative_doc_path} _remarks.pdf"
+            # The page is composed, its annotation layer isn't needed anymore
+            release_annotation_layer(rendered)
+            if low_memory:
+                fitz.TOOLS.store_shrink(100)
+                if len(replaced_pages) >= LOW_MEMORY_FLUSH_PAGES:
+                    flush_composed_pages()
+
+        add_to_markdown(page_idx, ann_data)
+        if ann_data and ann_data["highlights"]:
+            pending_highlights.append((page_idx, ann_data["highlights"], highlights_x_translation))
+
+    def flush_composed_pages():
+        # Move the finished pages into the source document, so the next ones start in an empty document
+        nonlocal composed_pages, replaced_pages
+        replace_pages(rmc_pdf_src, composed_pages, replaced_pages)
+        composed_pages.close()
+        composed_pages, replaced_pages = fitz.open(), {}
+
+    def finish_pending_page(page_idx, page_uuid, geometry, future):
+        rendered, svg_pdf_bytes, log_records = future.result()
+        for level, message in log_records:
+            logging.log(level, message)
+        if svg_pdf_bytes:
+            rendered.svg_pdf = fitz.open(stream=svg_pdf_bytes, filetype="pdf")
+        finish_page(page_idx, page_uuid, geometry, rendered)
+
+    def reuse_page(page_idx, parsed_page: ParsedPage, cached_page: fitz.Document):
+        # The cached page is finished, highlights included. The page is still parsed for the markdown.
+        replaced_pages[page_idx] = composed_pages.page_count
+        composed_pages.insert_pdf(cached_page)
+        (ann_data, has_ann_hl), version = parsed_page.parse()
+        add_to_markdown(page_idx, ann_data)
+
+    # With several page workers, annotation layers are parsed and rendered in other processes
+    # while this one composes the finished pages in page order
+    executor = ProcessPoolExecutor(max_workers=page_workers) if page_workers > 1 else None
+    pending_pages = deque()
+
+    try:
+        for (
+                page_uuid,
+                page_idx,
+                parsed_page,
+        ) in document.pages():
+            logging.info(f"processing page {page_idx + 1}, {page_uuid}")
+            page = rmc_pdf_src[page_idx]
+
+            if parsed_page and parsed_page.version == ReMarkableAnnotationsFileHeaderVersion.V6:
+                document.fit_notebook_page(page, parsed_page)
+                # Get PDF page dimensions BEFORE parsing to ensure correct SCALE is used
+                geometry = page_geometry(page)
+                cached_page = cache.cached_page(page_uuid) if cache else None
+
+                if cached_page:
+                    logging.info("Page unchanged since the last conversion, reusing it")
+                    reuse_page(page_idx, parsed_page, cached_page)
+                elif executor:
+                    future = executor.submit(_render_page_job, parsed_page.file_path, parsed_page.data, geometry,
+                                             device, in_memory, render_cache, logging.getLogger().getEffectiveLevel())
+                    pending_pages.append((page_idx, page_uuid, geometry, future))
+                    if low_memory and len(pending_pages) > 2 * page_workers:
+                        # Keep the workers busy, without holding on to the rendered layers of the whole document
+                        finish_pending_page(*pending_pages.popleft())
+                else:
+                    finish_page(page_idx, page_uuid, geometry,
+                                render_page(parsed_page, geometry, device, in_memory, render_cache))
+            else:
+                scrybble_warning_only_v6_supported.render_as_annotation(page)
+
+        while pending_pages:
+            # Dropped as they are finished, so the rendered layers they hold aren't kept until the end
+            finish_pending_page(*pending_pages.popleft())
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    flush_composed_pages()
+
+    for page_idx, highlights, highlights_x_translation in pending_highlights:
+        for highlight in highlights:
+            apply_smart_highlight(rmc_pdf_src[page_idx], highlight, highlights_x_translation, combined_highlights)
+
+    if render_times:
+        rendering = "in-memory" if in_memory else "temporary file"
+        logging.info(f"Rendered {len(render_times)} annotated pages in {sum(render_times):.2f} s, "
+                     f"{sum(render_times) / len(render_times) * 1000:.1f} ms per page ({rendering} rendering)")
+    if render_cache_hits:
+        logging.info(f"Reused {render_cache_hits} annotated pages from the render cache")
+
     output_pdf_path.parent.mkdir(parents=True, exist_ok=True)
-    rmc_pdf_src.save(output_pdf_path)
+    save_pdf(rmc_pdf_src, output_pdf_path, pdf_profile)
 
-    output_obsidian_path = output_dir/f"{relative_doc_path}"
     obsidian_markdown.save(output_obsidian_path)
+
+    if cache:
+        for page_idx, page_uuid in rendered_pages.items():
+            cache.store_page(page_uuid, rmc_pdf_src, page_idx)
+        cache.save()
+
+    return True
+
+
+@dataclass
+class PageGeometry:
+    """The background of a page, as it appears on the reMarkable"""
+    width: float
+    height: float
+    rotation: int
+    has_backing_pdf: bool
+
+
+@dataclass
+class RenderedPage:
+    """The annotation layer of a page, ready to be composed onto its background"""
+    annotations: TMetaData
+    svg_pdf: Optional[fitz.Document] = None
+    bounds: Optional[Tuple[float, float, float, float]] = None
+    """(x_shift, y_shift, w_svg, h_svg) of the annotations, only computed for pages with a backing pdf"""
+    render_time: float = 0
+    from_render_cache: bool = False
+    failed: bool = False
+
+
+def page_geometry(page: fitz.Page) -> PageGeometry:
+    page_rotation = page.rotation
+    page.set_rotation(0)
+    w_bg, h_bg = page.cropbox.width, page.cropbox.height
+    if int(page_rotation) in [90, 270]:
+        w_bg, h_bg = h_bg, w_bg
+    page.set_rotation(page_rotation)  # Restore rotation
+
+    return PageGeometry(w_bg, h_bg, page_rotation, bool(page.get_contents()))
+
+
+def render_page(parsed_page: ParsedPage, geometry: PageGeometry, device: str = None,
+                in_memory: bool = False, render_cache: Optional[RenderCache] = None) -> RenderedPage:
+    w_bg, h_bg = geometry.width, geometry.height
+
+    # Set SVG dimensions: use PDF dimensions if there's backing content,
+    # otherwise use device setting for notebooks
+    if geometry.has_backing_pdf:
+        logging.info(f"Setting page dimensions based on pdf: {round(w_bg,2)} x {round(h_bg,2)}")
+        set_dimensions_for_pdf(w_bg, h_bg)
+    elif device:
+        logging.info(f"Setting page dimensions based on device: {device}")
+        set_device(device)
+    else:
+        logging.warning(f"Unknown device and no backing pdf: setting page size to RMPP (if this is incorrect, specify device with --device)")
+        set_device('RMPP')
+
+    (ann_data, has_ann_hl), version = parsed_page.parse()
+    rendered = RenderedPage(ann_data)
+
+    try:
+        cache_key = None
+        if render_cache:
+            page_size = ["pdf", round(w_bg, 3), round(h_bg, 3)] if geometry.has_backing_pdf else ["device", device or "RMPP"]
+            cache_key = render_cache.key(parsed_page.data, page_size, in_memory)
+            rendered.svg_pdf = render_cache.get(cache_key)
+            if rendered.svg_pdf:
+                rendered.from_render_cache = True
+                logging.debug("Reusing rendered annotations from the render cache")
+
+        if not rendered.svg_pdf:
+            # convert the pdf
+            render_start = time.perf_counter()
+            rendered.svg_pdf = render_annotation_layer(ann_data["scene_tree"], in_memory=in_memory)
+            rendered.render_time = time.perf_counter() - render_start
+            logging.debug(f"Rendered annotations in {rendered.render_time * 1000:.1f} ms")
+            if cache_key:
+                render_cache.put(cache_key, rendered.svg_pdf)
+
+        if geometry.has_backing_pdf:
+            # find the (top, right) coordinates of the svg
+            anchor_pos = build_anchor_pos(ann_data["scene_tree"].root_text)
+            # Convert PDF dimensions to screen coordinates for bounding box default
+            # PDF uses points (72 DPI), screen uses device DPI; SCALE = 72/DPI
+            # reMarkable uses center-top origin: x from -w/2 to w/2, y from 0 to h
+            w_bg_screen = w_bg / rmc_config.scale
+            h_bg_screen = h_bg / rmc_config.scale
+            pdf_default_bounds = (-w_bg_screen / 2, w_bg_screen / 2, 0, h_bg_screen)
+            x_min, x_max, y_min, y_max = get_bounding_box(
+                ann_data["scene_tree"].root, anchor_pos, default=pdf_default_bounds
+            )
+            rendered.bounds = rmc_config.xx(x_min), rmc_config.yy(y_min), rmc_config.xx(x_max - x_min + 1), rmc_config.yy(y_max - y_min + 1)
+    except AttributeError:
+        rendered.failed = True
+
+    return rendered
+
+
+def compose_page(rmc_pdf_src: fitz.Document, page_idx: int, geometry: PageGeometry, rendered: RenderedPage,
+                 composed_pages: fitz.Document, replaced_pages: Dict[int, int]) -> float:
+    """Add the finished page to `composed_pages` and return the x-offset smart highlights need on it.
+
+    A page whose annotations fit within it, and that isn't rotated, is finished in place instead."""
+    svg_pdf = rendered.svg_pdf
+    w_bg, h_bg = geometry.width, geometry.height
+    highlights_x_translation = 0
+
+    # if the background page is not empty, need to merge svg on top of background page
+    if geometry.has_backing_pdf:
+        x_shift, y_shift, w_svg, h_svg = rendered.bounds
+
+        # compute the width/height of a blank page that can contain both svg and background pdf
+        width, height = max(w_svg, w_bg), max(h_svg, h_bg)
+        # compute position of svg and background in the new_page
+        # reMarkable (0,0) is at center-top of PDF page
+        # SVG coordinates need to be positioned relative to this center-top origin
+        x_svg, y_svg = 0, 0
+        x_bg, y_bg = 0, 0
+
+        if w_svg > w_bg:
+            x_bg = width / 2 - w_bg / 2 - (w_svg / 2 + x_shift)
+            # Highlights need to account for reMarkable's center-top origin: PDF center = w_bg/2
+            highlights_x_translation = x_bg + w_bg / 2
+        elif w_svg < w_bg:
+            x_svg = width / 2 - w_svg / 2 + (w_svg / 2 + x_shift)
+            # When SVG is smaller, PDF spans full width, so center is at w_bg/2
+            highlights_x_translation = w_bg / 2
+        if h_svg > h_bg:
+            y_bg = - y_shift
+        elif h_svg < h_bg:
+            y_svg = y_shift
+
+        if (width, height) == (w_bg, h_bg) and geometry.rotation == 0:
+            # The annotations fit on the page as it is: draw them straight onto it, the page keeps its own
+            # content and resources instead of being copied into a new page as a whole
+            rmc_pdf_src[page_idx].show_pdf_page(fitz.Rect(x_svg, y_svg, x_svg + w_svg, y_svg + h_svg), svg_pdf, 0)
+            return highlights_x_translation
+
+        # create the merged page in an independent document as show_pdf_page can't be done on the same document
+        merged_page = composed_pages.new_page(-1,
+                                              width=width,
+                                              height=height)
+        replaced_pages[page_idx] = merged_page.number
+        merged_page.show_pdf_page(fitz.Rect(x_bg, y_bg, x_bg + w_bg, y_bg + h_bg),
+                                  rmc_pdf_src,
+                                  page_idx,
+                                  rotate=-geometry.rotation)
+        merged_page.show_pdf_page(fitz.Rect(x_svg, y_svg, x_svg + w_svg, y_svg + h_svg),
+                                  svg_pdf,
+                                  0)
+    else:
+        replaced_pages[page_idx] = composed_pages.page_count
+        composed_pages.insert_pdf(svg_pdf)
+
+    return highlights_x_translation
+
+
+# In low memory mode, finished pages are moved out of the document they are composed in every so many pages
+LOW_MEMORY_FLUSH_PAGES = 32
+
+
+def release_annotation_layer(rendered: RenderedPage):
+    """Let go of a page's annotation layer and scene tree once the page is composed"""
+    if rendered.svg_pdf:
+        rendered.svg_pdf.close()
+        rendered.svg_pdf = None
+    if rendered.annotations:
+        rendered.annotations["scene_tree"] = None
+
+
+def _render_page_job(file_path, data: bytes, geometry: PageGeometry, device, in_memory, render_cache, log_level):
+    """Entry point for a page worker process. The scene tree stays behind, the rendered layer travels as PDF bytes."""
+    with _collect_logs(log_level) as log_records:
+        rendered = render_page(ParsedPage(file_path, data), geometry, device, in_memory, render_cache)
+
+    rendered.annotations["scene_tree"] = None
+    svg_pdf_bytes = rendered.svg_pdf.tobytes() if rendered.svg_pdf else None
+    rendered.svg_pdf = None
+    return rendered, svg_pdf_bytes, log_records
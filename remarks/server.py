@@ -1,13 +1,31 @@
 import logging
 import pathlib
 import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import TimeoutError
 
-from flask import Flask, request
+from flask import Flask, request, send_file, url_for
 
-import remarks
 import sentry_sdk
 
+from remarks.jobs import JobQueue, QueueFull
+
 app = Flask("Remarks http server")
+# Uploaded archives are streamed to a temporary file, the conversion workers read it from there
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("REMARKS_MAX_UPLOAD_SIZE", "1024")) * 1024 * 1024
+
+# Conversions run in worker processes next to the web server, which only queues them
+jobs = JobQueue(
+    workers=int(os.getenv("REMARKS_CONVERSION_WORKERS", "2")),
+    max_queued=int(os.getenv("REMARKS_MAX_QUEUED_JOBS", "16")),
+    pdf_profile=os.getenv("REMARKS_PDF_PROFILE", "compact"),
+    low_memory=os.getenv("REMARKS_LOW_MEMORY", "0") == "1",
+    archive_ttl=float(os.getenv("REMARKS_ARCHIVE_TTL", "600")),
+)
+# How long /convert waits for a conversion before pointing to where its output can be downloaded later
+CONVERT_WAIT = float(os.getenv("REMARKS_CONVERT_WAIT", "30"))
 
 def main_prod():
     """Production entry point using Gunicorn"""
@@ -21,20 +39,29 @@ def main_prod():
         logging.info("Initialized Sentry")
 
     # Gunicorn configuration
+    # A single worker owns the job queue, requests only queue conversions or report on them and return right away.
+    # The worker isn't recycled after a number of requests, that would kill the conversions it is running.
+    # The app is loaded once in the master, and the hooks below come from this module too.
     sys.argv = [
         'gunicorn',
         '--bind', '0.0.0.0:5000',
-        '--workers', '2',
-        '--worker-class', 'sync',
-        '--timeout', '300',  # 5 minutes for file processing
-        '--max-requests', '1000',
-        '--max-requests-jitter', '100',
+        '--workers', '1',
+        '--worker-class', 'gthread',
+        '--threads', '8',
+        '--timeout', '60',
+        '--preload',
+        '--config', 'python:remarks.server',
         'remarks.server:app'
     ]
 
     wsgi.run()
 
 
+def post_fork(server, worker):
+    """Gunicorn hook: start the warmed up conversion workers as soon as the worker is, not on the first request"""
+    jobs.start()
+
+
 @app.post("/process")
 def process():
     params = request.get_json()
@@ -48,15 +75,92 @@ def process():
         return {"error": f"Input path does not exist: {in_path}"}, 400
 
     try:
-        out_dir = in_path.parent/"out"
-        out_dir.mkdir(parents=True, exist_ok=True)
-
-        remarks.run_remarks(in_path, out_dir)
-        return {"status": "success"}, 200
-    except Exception as e:
-        logging.error(f"Processing failed: {e}")
-        sentry_sdk.capture_exception(e)
-        return {"error": "Processing failed"}, 500
+        job = jobs.submit(in_path, in_path.parent/"out")
+    except QueueFull as e:
+        logging.warning(f"Rejected conversion of {in_path}: {e}")
+        return {"error": "Too many conversions queued, try again later"}, 429, {"Retry-After": "30"}
+
+    return {"status": "queued", "job_id": job.id}, 202
+
+
+@app.post("/convert")
+def convert():
+    """Convert the .rmn/.rmdoc archive in the request body, responding with a zip archive of the output.
+
+    Conversions that take longer than CONVERT_WAIT respond with 202 and the URL to download the output from."""
+    # The conversion worker opens the upload by path, so it goes straight to a named temporary file
+    upload = tempfile.NamedTemporaryFile(prefix="remarks-upload-", suffix=".rmn", delete=False)
+    upload_path = pathlib.Path(upload.name)
+    try:
+        with upload:
+            shutil.copyfileobj(request.stream, upload, 1024 * 1024)
+    except BaseException:
+        # The upload is too large, or the client went away
+        upload_path.unlink(missing_ok=True)
+        raise
+    if not zipfile.is_zipfile(upload_path):
+        upload_path.unlink()
+        return {"error": "Expected a .rmn or .rmdoc archive as the request body"}, 400
+
+    name = request.args.get("name", "upload.rmn")
+    try:
+        job = jobs.submit_archive(name, upload_path)
+    except QueueFull as e:
+        upload_path.unlink()
+        logging.warning(f"Rejected conversion of {name}: {e}")
+        return {"error": "Too many conversions queued, try again later"}, 429, {"Retry-After": "30"}
+
+    try:
+        job.future.result(timeout=CONVERT_WAIT)
+    except TimeoutError:
+        return {"status": "running", "job_id": job.id,
+                "archive_url": url_for("job_archive", job_id=job.id)}, 202, {"Retry-After": "10"}
+    except BaseException:
+        pass
+    return archive_response(job)
+
+
+@app.get("/jobs/<job_id>/archive")
+def job_archive(job_id):
+    """The output of a /convert job, which can be downloaded once"""
+    job = jobs.get(job_id)
+    if not job:
+        return {"error": f"Unknown job: {job_id}"}, 404
+    if not job.future.done():
+        return {"status": "running", "job_id": job.id}, 202, {"Retry-After": "10"}
+    return archive_response(job)
+
+
+def archive_response(job):
+    try:
+        result = job.future.result(timeout=0)
+    except BaseException:
+        return {"error": "Processing failed", "job_id": job.id}, 500
+    if result.summary.failed:
+        return {"error": "Processing failed", "failed": list(result.summary.failed), "job_id": job.id}, 500
+
+    archive = jobs.take_archive(job)
+    if not archive:
+        return {"error": "The output of this job was downloaded already, or expired", "job_id": job.id}, 410
+    output = archive.open("rb")
+    # The open file stays readable until the response is sent and closes it
+    archive.unlink()
+    response = send_file(output, mimetype="application/zip", as_attachment=True, download_name="remarks.zip")
+    response.headers["X-Remarks-Job-Id"] = job.id
+    return response
+
+
+@app.get("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if not job:
+        return {"error": f"Unknown job: {job_id}"}, 404
+    return job.to_dict(), 200
+
+
+@app.get("/jobs")
+def job_list():
+    return {"jobs": [job.to_dict() for job in jobs.list()]}, 200
 
 @app.route("/health")
 def health():
@@ -0,0 +1,122 @@
+import fnmatch
+import io
+import pathlib
+import zipfile
+from abc import ABC, abstractmethod
+from typing import BinaryIO, Dict, List, Optional, Union
+
+import fitz
+
+
+class InputSource(ABC):
+    """Where the files of a xochitl-like directory are read from.
+
+    Files are addressed by path everywhere in remarks, a source decides what a path points to."""
+
+    @abstractmethod
+    def exists(self, path: pathlib.Path) -> bool:
+        pass
+
+    @abstractmethod
+    def read_bytes(self, path: pathlib.Path) -> bytes:
+        pass
+
+    @abstractmethod
+    def glob(self, directory: pathlib.Path, pattern: str) -> List[pathlib.Path]:
+        """The files directly in `directory` whose name matches `pattern`"""
+
+    def open_pdf(self, path: pathlib.Path) -> fitz.Document:
+        return fitz.open(stream=self.read_bytes(path), filetype="pdf")
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DirectorySource(InputSource):
+    """Files on disk, paths are plain file system paths"""
+
+    def exists(self, path: pathlib.Path) -> bool:
+        return path.exists()
+
+    def read_bytes(self, path: pathlib.Path) -> bytes:
+        return path.read_bytes()
+
+    def glob(self, directory: pathlib.Path, pattern: str) -> List[pathlib.Path]:
+        if not directory.is_dir():
+            return []
+        return list(directory.glob(pattern))
+
+    def open_pdf(self, path: pathlib.Path) -> fitz.Document:
+        return fitz.open(path)
+
+
+class ZipSource(InputSource):
+    """The members of a .rmn/.rmdoc archive, read straight from the archive without extracting it.
+
+    Paths are the member names below `root`, which is usually the path of the archive itself:
+    `{root}/{uuid}.metadata`, `{root}/{uuid}/{page uuid}.rm` and so on."""
+
+    def __init__(self, archive: Union[pathlib.Path, BinaryIO], root: Optional[pathlib.Path] = None):
+        self.archive = archive
+        self.root = root or pathlib.Path(archive)
+        self._open()
+
+    def _open(self):
+        self._zip = zipfile.ZipFile(self.archive)
+        # Archives made by reMarkable's apps name their members with a leading "/"
+        self._members: Dict[pathlib.PurePosixPath, zipfile.ZipInfo] = {
+            pathlib.PurePosixPath(info.filename.strip("/")): info
+            for info in self._zip.infolist() if not info.is_dir()
+        }
+
+    def _member(self, path: pathlib.Path) -> Optional[zipfile.ZipInfo]:
+        try:
+            return self._members.get(pathlib.PurePosixPath(path.relative_to(self.root).as_posix()))
+        except ValueError:
+            return None
+
+    def exists(self, path: pathlib.Path) -> bool:
+        return self._member(path) is not None
+
+    def read_bytes(self, path: pathlib.Path) -> bytes:
+        member = self._member(path)
+        if member is None:
+            raise FileNotFoundError(f"{path} is not in {self.root}")
+        return self._zip.read(member)
+
+    def glob(self, directory: pathlib.Path, pattern: str) -> List[pathlib.Path]:
+        try:
+            member_dir = pathlib.PurePosixPath(directory.relative_to(self.root).as_posix())
+        except ValueError:
+            return []
+        return [
+            directory / name.name
+            for name in self._members
+            if name.parent == member_dir and fnmatch.fnmatch(name.name, pattern)
+        ]
+
+    def close(self):
+        self._zip.close()
+
+    def __getstate__(self):
+        # Handed to document workers: reopened there from the path, or from the bytes of an in-memory archive
+        archive = self.archive
+        if not isinstance(archive, (str, pathlib.Path)):
+            archive.seek(0)
+            archive = io.BytesIO(archive.read())
+        return {"archive": archive, "root": self.root}
+
+    def __setstate__(self, state):
+        self.archive = state["archive"]
+        self.root = state["root"]
+        self._open()
+
+
+def is_archive(path: pathlib.Path) -> bool:
+    return path.name.endswith(".rmn") or path.name.endswith(".rmdoc")
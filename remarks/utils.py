@@ -1,8 +1,9 @@
 import json
 import pathlib
 import re
-from functools import cache
-from typing import Tuple, List
+from typing import Dict, Tuple, List, Optional
+
+from remarks.sources import InputSource, DirectorySource
 
 # reMarkable's device dimensions
 RM_WIDTH = 1404
@@ -11,32 +12,65 @@ RM_HEIGHT = 1872
 INSERTED_PAGE = -1
 
 
-@cache
-def read_meta_file(path, suffix=".metadata"):
-    file = path.with_name(f"{path.stem}{suffix}")
-    if not file.exists():
+class MetadataStore:
+    """The .metadata and .content files of one xochitl-like directory, indexed by UUID.
+
+    A store belongs to a single run of remarks: it reads every file at most once, and is dropped together with
+    the run, so nothing outlives it and a later run always sees the files as they are then.
+
+    The files are read from `source`, the other files of the documents are read through it as well."""
+
+    def __init__(self, directory: Optional[pathlib.Path] = None, source: Optional[InputSource] = None):
+        self.source = source or DirectorySource()
+        self._files: Dict[Tuple[str, str], Optional[dict]] = {}
+        if directory:
+            for suffix in [".metadata", ".content"]:
+                for file in self.source.glob(directory, f"*{suffix}"):
+                    self._files[(file.stem, suffix)] = json.loads(self.source.read_bytes(file))
+
+    def read(self, path: pathlib.Path, suffix=".metadata") -> Optional[dict]:
+        key = (path.stem, suffix)
+        if key not in self._files:
+            # Not part of the directory the store was loaded from
+            self._files[key] = _read_json_file(path.with_name(f"{path.stem}{suffix}"), self.source)
+        return self._files[key]
+
+    def subset(self, uuids: List[str]) -> "MetadataStore":
+        """A store with just these documents, cheap to hand to another process"""
+        store = MetadataStore(source=self.source)
+        store._files = {key: data for key, data in self._files.items() if key[0] in uuids}
+        return store
+
+
+def _read_json_file(file: pathlib.Path, source: InputSource) -> Optional[dict]:
+    if not source.exists(file):
         return None
-    data = json.loads(open(file).read())
-    return data
+    return json.loads(source.read_bytes(file))
+
+
+def read_meta_file(path, suffix=".metadata", store: Optional[MetadataStore] = None):
+    if store:
+        return store.read(path, suffix)
+    return _read_json_file(path.with_name(f"{path.stem}{suffix}"), DirectorySource())
 
 
-def is_document(path):
-    metadata = read_meta_file(path)
+def is_document(path, store: Optional[MetadataStore] = None):
+    metadata = read_meta_file(path, store=store)
     return metadata["type"] == "DocumentType"
 
 
-def get_document_filetype(path):
-    content = read_meta_file(path, suffix=".content")
+def get_document_filetype(path, store: Optional[MetadataStore] = None):
+    content = read_meta_file(path, suffix=".content", store=store)
     return content["fileType"]
 
 
-def get_visible_name(path):
-    metadata = read_meta_file(path)
+def get_visible_name(path, store: Optional[MetadataStore] = None):
+    metadata = read_meta_file(path, store=store)
     return metadata["visibleName"]
 
 
-def get_ui_path(path):
-    metadata = read_meta_file(path)
+def get_ui_path(path, store: Optional[MetadataStore] = None):
+    metadata = read_meta_file(path, store=store)
     parent_filename = metadata["parent"]
 
     # Check the parent
@@ -47,7 +81,7 @@ def get_ui_path(path):
         parent_path = pathlib.Path(path.parent, metadata["parent"])
 
         # Get the meta data of this parent
-        metadata = read_meta_file(parent_path)
+        metadata = read_meta_file(parent_path, store=store)
         if not metadata:
             return pathlib.Path(".")
 
@@ -122,8 +156,8 @@ def is_inserted_page(idx: int) -> bool:
 def is_duplicate_page(idx: int) -> bool:
     return idx >= 0
 
-def get_document_tags(path: str):
-    content = read_meta_file(path, suffix=".content")
+def get_document_tags(path: str, store: Optional[MetadataStore] = None):
+    content = read_meta_file(path, suffix=".content", store=store)
     if "tags" in content:
         for tag in content['tags']:
             yield sanitize_obsidian_tag(tag['name'])
@@ -177,21 +211,28 @@ def sanitize_obsidian_tag(tag: str) -> str:
     return tag
 
 
-def get_page_tags(path: str, page_id: str) -> List[str]:
+def get_page_tags(path: str, page_id: str, store: Optional[MetadataStore] = None) -> List[str]:
     """Extract tags for a specific page from the content file"""
-    content = read_meta_file(path, suffix=".content")
-    if "pageTags" in content:
-        page_tags = []
-        for tag_entry in content["pageTags"]:
-            if tag_entry["pageId"] == page_id:
-                sanitized_tag = sanitize_obsidian_tag(tag_entry["name"])
-                if sanitized_tag:  # Only add non-empty tags
-                    page_tags.append(sanitized_tag)
-        return page_tags
-    return []
-
-def get_pages_data(path: str) -> Tuple[List[str], List[int]]:
-    content = read_meta_file(path, suffix=".content")
+    return get_page_tags_index(path, store=store).get(page_id, [])
+
+
+def get_page_tags_index(path: str, store: Optional[MetadataStore] = None) -> Dict[str, List[str]]:
+    """Extract the tags of every page from the content file, keyed by page id"""
+    content = read_meta_file(path, suffix=".content", store=store)
+    page_tags: Dict[str, List[str]] = {}
+    # The same few tags are usually used on many pages, sanitize each of them once
+    sanitized_tags: Dict[str, str] = {}
+    for tag_entry in content.get("pageTags", []):
+        tag = tag_entry["name"]
+        if tag not in sanitized_tags:
+            sanitized_tags[tag] = sanitize_obsidian_tag(tag)
+        sanitized_tag = sanitized_tags[tag]
+        if sanitized_tag:  # Only add non-empty tags
+            page_tags.setdefault(tag_entry["pageId"], []).append(sanitized_tag)
+    return page_tags
+
+def get_pages_data(path: str, store: Optional[MetadataStore] = None) -> Tuple[List[str], List[int]]:
+    content = read_meta_file(path, suffix=".content", store=store)
     redirection_map = construct_redirection_map(content)
     if "cPages" in content:
         return [page["id"] for page in content["cPages"]["pages"] if not page.get("deleted", {
@@ -199,8 +240,6 @@ def get_pages_data(path: str) -> Tuple[List[str], List[int]]:
     return content["pages"], redirection_map
 
 
-def list_ann_rm_files(path):
+def list_ann_rm_files(path, source: Optional[InputSource] = None):
     content_dir = pathlib.Path(f"{path.parents[0]}/{path.stem}/")
-    if not content_dir.is_dir():
-        return []
-    return list(content_dir.glob("*.rm"))
+    return (source or DirectorySource()).glob(content_dir, "*.rm")
@@ -0,0 +1,132 @@
+"""Conversion modes that only change how a document is converted produce the same output as a plain conversion."""
+import json
+import logging
+import pathlib
+import re
+import sys
+import uuid
+import zipfile
+
+import fitz
+import pytest
+
+import remarks
+from remarks.output.PdfFile import PDF_SAVE_PROFILES
+
+fixtures = [
+    "tests/in/on computable numbers - RMPP - highlighter tool v6.rmn",
+    "tests/in/rmpp - v6 - various colors.rmn",
+    "tests/in/rmpp - typed text.rmn",
+    "tests/in/rmpp - expanded margins.rmn",
+]
+
+
+def output_files(output_dir: pathlib.Path):
+    return sorted(path.relative_to(output_dir) for path in output_dir.rglob("*")
+                  if path.is_file() and ".remarks-cache" not in path.parts)
+
+
+def assert_same_pdf(expected: pathlib.Path, actual: pathlib.Path):
+    expected_pdf, actual_pdf = fitz.open(expected), fitz.open(actual)
+    assert actual_pdf.page_count == expected_pdf.page_count
+    for expected_page, actual_page in zip(expected_pdf, actual_pdf):
+        assert actual_page.rect == expected_page.rect
+        assert [(annot.type, annot.vertices, annot.colors) for annot in actual_page.annots()] == \
+               [(annot.type, annot.vertices, annot.colors) for annot in expected_page.annots()]
+        assert actual_page.get_pixmap(dpi=50).samples == expected_page.get_pixmap(dpi=50).samples
+
+
+def assert_same_markdown(expected: pathlib.Path, actual: pathlib.Path):
+    def without_timestamp(path):
+        return [line for line in path.read_text().splitlines() if "scrybble_timestamp" not in line]
+
+    assert without_timestamp(actual) == without_timestamp(expected)
+
+
+def assert_same_output(expected_dir: pathlib.Path, actual_dir: pathlib.Path):
+    assert output_files(expected_dir), f"Nothing was converted to {expected_dir}"
+    assert output_files(actual_dir) == output_files(expected_dir)
+    for path in output_files(expected_dir):
+        if path.suffix == ".pdf":
+            assert_same_pdf(expected_dir / path, actual_dir / path)
+        else:
+            assert_same_markdown(expected_dir / path, actual_dir / path)
+
+
+def extract_documents(directory: pathlib.Path) -> pathlib.Path:
+    """Every fixture in a single xochitl-like directory, and a document whose PDF is broken"""
+    for fixture in fixtures:
+        with zipfile.ZipFile(fixture) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    path = directory / info.filename.strip("/")
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    path.write_bytes(archive.read(info))
+
+    pdf = sorted(directory.glob("*.pdf"))[0]
+    broken = directory / str(uuid.uuid4())
+    for path in directory.glob(f"{pdf.stem}.*"):
+        path.with_stem(broken.name).write_bytes(path.read_bytes())
+    metadata = json.loads(broken.with_suffix(".metadata").read_text())
+    broken.with_suffix(".metadata").write_text(json.dumps({**metadata, "visibleName": "Broken"}))
+    broken.with_suffix(".pdf").write_bytes(b"%PDF-1.7 broken")
+    return directory
+
+
+@pytest.fixture(scope="module")
+def plain_outputs(tmp_path_factory):
+    """Every fixture converted without any options"""
+    outputs = {}
+    for fixture in fixtures:
+        outputs[fixture] = tmp_path_factory.mktemp("plain")
+        remarks.run_remarks(pathlib.Path(fixture), outputs[fixture])
+    return outputs
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("fixture", fixtures)
+def test_page_workers_match_serial_conversion(fixture, plain_outputs, tmp_path):
+    remarks.run_remarks(pathlib.Path(fixture), tmp_path, page_workers=3)
+    assert_same_output(plain_outputs[fixture], tmp_path)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("fixture", fixtures)
+@pytest.mark.parametrize("page_workers", [1, 3])
+def test_low_memory_matches_plain_conversion(fixture, page_workers, plain_outputs, tmp_path, monkeypatch):
+    # Flush composed pages every other page, the fixtures are shorter than a real flush
+    monkeypatch.setattr(sys.modules["remarks.remarks"], "LOW_MEMORY_FLUSH_PAGES", 2)
+    remarks.run_remarks(pathlib.Path(fixture), tmp_path, low_memory=True, page_workers=page_workers)
+    assert_same_output(plain_outputs[fixture], tmp_path)
+
+
+@pytest.mark.pdf
+def test_document_workers_match_serial_conversion(tmp_path):
+    input_dir = extract_documents(tmp_path / "in")
+    serial = remarks.run_remarks(input_dir, tmp_path / "serial")
+    parallel = remarks.run_remarks(input_dir, tmp_path / "parallel", workers=2)
+
+    assert len(parallel.converted) == len(fixtures)
+    assert sorted(parallel.converted) == sorted(serial.converted)
+    assert [pathlib.Path(document).name for document in parallel.failed] == ["Broken"]
+    assert parallel.failed.keys() == serial.failed.keys()
+    assert_same_output(tmp_path / "serial", tmp_path / "parallel")
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("fixture", fixtures)
+def test_pdf_profiles_only_change_the_file_size(fixture, plain_outputs, tmp_path, caplog):
+    sizes = {}
+    for profile in PDF_SAVE_PROFILES:
+        output_dir = tmp_path / profile
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            remarks.run_remarks(pathlib.Path(fixture), output_dir, pdf_profile=profile)
+        assert_same_output(plain_outputs[fixture], output_dir)
+
+        [pdf] = output_dir.glob("*.pdf")
+        sizes[profile] = pdf.stat().st_size
+        [saved] = [record.message for record in caplog.records if record.message.startswith(f"Saved {pdf} ")]
+        assert re.fullmatch(rf"Saved .* with the {profile} profile in \d+\.\d\d s, \d+ KiB", saved)
+
+    assert sizes["compact"] < sizes["fast"]
@@ -0,0 +1,90 @@
+"""Incremental conversions skip what didn't change since the last conversion, and produce the same output anyway."""
+import logging
+import pathlib
+import zipfile
+
+import pytest
+
+import remarks
+from remarks.cache import CACHE_DIRECTORY_NAME
+from test_conversion_modes import assert_same_output
+
+fixture = pathlib.Path("tests/in/rmpp - v6 - various colors.rmn")
+
+
+def extract(archive: pathlib.Path, directory: pathlib.Path) -> pathlib.Path:
+    with zipfile.ZipFile(archive) as zip_ref:
+        for info in zip_ref.infolist():
+            if not info.is_dir():
+                path = directory / info.filename.strip("/")
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(zip_ref.read(info))
+    return directory
+
+
+def messages(caplog, text: str) -> list:
+    return [record.message for record in caplog.records if record.message.startswith(text)]
+
+
+@pytest.mark.pdf
+def test_unchanged_document_is_skipped(tmp_path):
+    output_dir = tmp_path / "out"
+    first = remarks.run_remarks(fixture, output_dir, incremental=True)
+    assert len(first.converted) == 1
+    assert (output_dir / CACHE_DIRECTORY_NAME).is_dir()
+
+    second = remarks.run_remarks(fixture, output_dir, incremental=True)
+    assert second.converted == []
+    assert second.skipped == first.converted
+
+
+@pytest.mark.pdf
+def test_missing_output_is_converted_again(tmp_path):
+    output_dir = tmp_path / "out"
+    remarks.run_remarks(fixture, output_dir, incremental=True)
+    for pdf in output_dir.glob("*.pdf"):
+        pdf.unlink()
+
+    summary = remarks.run_remarks(fixture, output_dir, incremental=True)
+    assert len(summary.converted) == 1
+    assert list(output_dir.glob("*.pdf"))
+
+
+@pytest.mark.pdf
+def test_only_changed_page_is_rendered_again(tmp_path, caplog):
+    input_dir = extract(fixture, tmp_path / "in")
+    output_dir = tmp_path / "out"
+    remarks.run_remarks(input_dir, output_dir, incremental=True)
+
+    rm_files = sorted(input_dir.glob("*/*.rm"))
+    assert len(rm_files) > 1
+    # Draw the second page on the first one
+    rm_files[0].write_bytes(rm_files[1].read_bytes())
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        summary = remarks.run_remarks(input_dir, output_dir, incremental=True)
+    assert len(summary.converted) == 1
+    assert len(messages(caplog, "Page unchanged since the last conversion")) == len(rm_files) - 1
+    [rendered] = messages(caplog, "Rendered ")
+    assert rendered.startswith("Rendered 1 annotated pages")
+
+    # The stored pages of the last conversion are those of the current pages
+    cache_dir = next((output_dir / CACHE_DIRECTORY_NAME).iterdir())
+    assert sorted(path.stem for path in cache_dir.glob("*.pdf")) == sorted(path.stem for path in rm_files)
+
+    full_output_dir = tmp_path / "full"
+    remarks.run_remarks(input_dir, full_output_dir)
+    assert_same_output(full_output_dir, output_dir)
+
+
+@pytest.mark.pdf
+def test_changed_options_convert_again(tmp_path, caplog):
+    output_dir = tmp_path / "out"
+    remarks.run_remarks(fixture, output_dir, incremental=True)
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        summary = remarks.run_remarks(fixture, output_dir, incremental=True, combined_highlights=True)
+    assert len(summary.converted) == 1
+    assert not messages(caplog, "Page unchanged since the last conversion")
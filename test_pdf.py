@@ -1,10 +1,19 @@
+import pathlib
 import re
 from pprint import pprint
 
+import fitz
 from fitz import Document
 
+import remarks
+from remarks.conversion import parsing
+from remarks.conversion.geometry import WordIndex
+from remarks.conversion.parsing import ParsedPage
+from remarks.output import PdfFile
 from remarks.output.ObsidianMarkdownFile import merge_highlights
 from remarks.output.PdfFile import extract_annot
+from remarks.sources import ZipSource
+from remarks.utils import list_ann_rm_files
 from tests.notebook_fixtures import *
 from tests.pdf_test_support import assert_page_renders_without_warnings, assert_warning_exists
 
@@ -60,6 +69,24 @@ def test_smart_highlights(notebook: NotebookMetadata, remarks_document: Document
                 # TODO: We should implement the colour check as well, once that is ready.
 
 
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", all_notebooks, indirect=True)
+def test_smart_highlights_with_shared_word_index(notebook: NotebookMetadata, remarks_document: Document):
+    """Annotations on a page read the same text from one WordIndex for the whole page"""
+    for page_metadata in notebook.pages:
+        if page_metadata.raw_highlights:
+            if scrybble_warning_typed_text_highlighting_not_supported in page_metadata.warnings:
+                continue
+            document_page = remarks_document[page_metadata.pdf_document_index]
+            words_on_page = document_page.get_textpage().extractWORDS()
+            word_index = WordIndex(words_on_page)
+            annots = list(document_page.annots())
+
+            annots.sort(key=lambda a: (a.rect.y0, a.rect.x0))
+            assert [extract_annot(annotation, words_on_page, word_index) for annotation in annots] == \
+                   page_metadata.raw_highlights
+
+
 def demarkdown(markdown_text: str):
     """Takes in a Markdown string, and gets rid of all Markdown, essentially returning pure plaintext"""
 
@@ -183,3 +210,70 @@ def test_output_pdf_has_correct_dimensions(notebook: NotebookMetadata, remarks_d
                 f"Page {page_idx}: for {source_rotation}° rotation, output width ({output_width}) should match source width ({source_width})"
             assert abs(output_height - source_height) < 1, \
                 f"Page {page_idx}: for {source_rotation}° rotation, output height ({output_height}) should match source height ({source_height})"
+
+
+@pytest.mark.pdf
+def test_notebook_pages_are_decoded_once(monkeypatch, tmp_path):
+    """Notebook pages are sized to their drawing from the page that is converted, not from a page decoded just for it"""
+    notebook = pathlib.Path("tests/in/rmpp - v6 - various colors.rmn")
+    decoded_pages = []
+    read_blocks = parsing.read_blocks
+
+    def counting_read_blocks(data, *args, **kwargs):
+        decoded_pages.append(data)
+        return read_blocks(data, *args, **kwargs)
+
+    monkeypatch.setattr(parsing, "read_blocks", counting_read_blocks)
+    summary = remarks.run_remarks(notebook, tmp_path)
+
+    assert len(summary.converted) == 1
+    with ZipSource(notebook) as source:
+        [metadata_path] = source.glob(notebook, "*.metadata")
+        assert len(decoded_pages) == len(list_ann_rm_files(metadata_path, source))
+
+
+def highlight_annotations(output_dir: pathlib.Path) -> list:
+    [pdf] = output_dir.glob("*.pdf")
+    return [annot.vertices for page in fitz.open(pdf) for annot in page.annots(types=(fitz.PDF_ANNOT_HIGHLIGHT,))]
+
+
+def smart_highlights(archive: pathlib.Path) -> list:
+    with ZipSource(archive) as source:
+        [metadata_path] = source.glob(archive, "*.metadata")
+        return [highlight for rm_file in list_ann_rm_files(metadata_path, source)
+                for highlight in ParsedPage.from_file(rm_file, source).annotations()["highlights"]]
+
+
+@pytest.mark.pdf
+def test_combined_highlights_hold_every_line_of_a_highlight(tmp_path):
+    document = pathlib.Path("tests/in/multi-line highlights.rmn")
+    highlights = smart_highlights(document)
+    assert any(len(highlight.boxes) > 1 for highlight in highlights)
+
+    remarks.run_remarks(document, tmp_path / "separate")
+    remarks.run_remarks(document, tmp_path / "combined", combined_highlights=True)
+
+    # One annotation for every rectangle, or one for every highlight with a quad for each of its lines
+    separate, combined = highlight_annotations(tmp_path / "separate"), highlight_annotations(tmp_path / "combined")
+    quads_per_highlight = [len(highlight.boxes) for highlight in highlights]
+    assert [len(vertices) for vertices in separate] == [4] * sum(quads_per_highlight)
+    assert sorted(len(vertices) for vertices in combined) == sorted(4 * quads for quads in quads_per_highlight)
+    assert sorted(vertex for vertices in combined for vertex in vertices) == \
+           sorted(vertex for vertices in separate for vertex in vertices)
+
+
+@pytest.mark.pdf
+def test_combined_highlights_fall_back_to_an_annotation_per_rectangle(tmp_path, monkeypatch):
+    document = pathlib.Path("tests/in/multi-line highlights.rmn")
+    add_highlight_annot = PdfFile.add_highlight_annot
+
+    def add_single_highlight_annot(page, quads, highlight_color):
+        if isinstance(quads, list):
+            raise ValueError("bad quads")
+        return add_highlight_annot(page, quads, highlight_color)
+
+    remarks.run_remarks(document, tmp_path / "separate")
+    monkeypatch.setattr(PdfFile, "add_highlight_annot", add_single_highlight_annot)
+    remarks.run_remarks(document, tmp_path / "combined", combined_highlights=True)
+
+    assert highlight_annotations(tmp_path / "combined") == highlight_annotations(tmp_path / "separate")
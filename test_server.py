@@ -0,0 +1,166 @@
+"""The http server queues conversions in a JobQueue, and reports on them."""
+import io
+import pathlib
+import re
+import shutil
+import time
+import uuid
+import zipfile
+
+import pytest
+
+from remarks import server
+from remarks.jobs import JobQueue
+
+fixture = pathlib.Path("tests/in/rmpp - v6 - various colors.rmn")
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+@pytest.fixture
+def job_queue(monkeypatch):
+    queue = JobQueue(workers=1, max_queued=1)
+    monkeypatch.setattr(server, "jobs", queue)
+    yield queue
+    if queue._executor:
+        queue._executor.shutdown()
+
+
+def broken_archive(path: pathlib.Path) -> pathlib.Path:
+    """The fixture, with all of its members replaced by garbage"""
+    with zipfile.ZipFile(fixture) as source, zipfile.ZipFile(path, "w") as broken:
+        for name in source.namelist():
+            broken.writestr(name, b"garbage")
+    return path
+
+
+def copy_of_fixture(directory: pathlib.Path) -> pathlib.Path:
+    """/process writes the output next to its input"""
+    return pathlib.Path(shutil.copy(fixture, directory))
+
+
+def statuses_until_finished(client, job_id: str, timeout: float = 120) -> list:
+    """Every status the job reports, in order, until it is finished"""
+    statuses = []
+    deadline = time.time() + timeout
+    while not statuses or statuses[-1] not in ("succeeded", "failed"):
+        assert time.time() < deadline, f"Job {job_id} didn't finish, it is {statuses[-1]}"
+        response = client.get(f"/jobs/{job_id}")
+        assert response.status_code == 200
+        status = response.get_json()["status"]
+        if not statuses or statuses[-1] != status:
+            statuses.append(status)
+        time.sleep(0.01)
+    return statuses
+
+
+@pytest.mark.pdf
+def test_process_queues_a_job(client, job_queue, tmp_path):
+    in_path = copy_of_fixture(tmp_path)
+
+    response = client.post("/process", json={"in_path": str(in_path), "out_path": str(tmp_path / "out")})
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+
+    assert statuses_until_finished(client, job_id)[-1] == "succeeded"
+    assert list((tmp_path / "out").glob("*.pdf"))
+    assert [job["id"] for job in client.get("/jobs").get_json()["jobs"]] == [job_id]
+
+
+def test_unknown_job_is_not_found(client, job_queue):
+    assert client.get("/jobs/unknown").status_code == 404
+    assert client.get("/jobs/unknown/archive").status_code == 404
+
+
+@pytest.mark.pdf
+def test_full_queue_rejects_jobs(client, job_queue, tmp_path):
+    params = {"in_path": str(copy_of_fixture(tmp_path)), "out_path": str(tmp_path)}
+    job_queue.max_queued = 0
+
+    assert client.post("/process", json=params).status_code == 202
+    response = client.post("/process", json=params)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"]
+
+
+@pytest.mark.pdf
+def test_job_status_moves_from_queued_to_running_to_succeeded(client, job_queue, tmp_path):
+    # A first job that takes a while
+    many_documents = tmp_path / "many"
+    with zipfile.ZipFile(fixture) as archive:
+        for _ in range(8):
+            document_id = str(uuid.uuid4())
+            for info in archive.infolist():
+                name = re.sub(r"^/?[0-9a-f-]{36}", document_id, info.filename)
+                (many_documents / name).parent.mkdir(parents=True, exist_ok=True)
+                (many_documents / name).write_bytes(archive.read(info))
+    first = client.post("/process", json={"in_path": str(many_documents), "out_path": str(tmp_path)})
+    second = client.post("/process", json={"in_path": str(copy_of_fixture(tmp_path)), "out_path": str(tmp_path)})
+    first, second = first.get_json()["job_id"], second.get_json()["job_id"]
+
+    # The only worker is busy with the first job, the second one waits for it, even in the executor's call queue
+    while client.get(f"/jobs/{first}").get_json()["started_at"] is None:
+        time.sleep(0.01)
+    assert client.get(f"/jobs/{second}").get_json()["status"] == "queued"
+    assert client.get(f"/jobs/{first}").get_json()["status"] == "running"
+
+    assert statuses_until_finished(client, second)[-2:] == ["running", "succeeded"]
+    assert client.get(f"/jobs/{first}").get_json()["status"] == "succeeded"
+    job = client.get(f"/jobs/{second}").get_json()
+    assert job["created_at"] <= job["started_at"] <= job["finished_at"]
+
+
+@pytest.mark.pdf
+def test_failed_job(client, job_queue, tmp_path):
+    in_path = broken_archive(tmp_path / fixture.name)
+
+    job_id = client.post("/process", json={"in_path": str(in_path), "out_path": str(tmp_path)}).get_json()["job_id"]
+
+    assert statuses_until_finished(client, job_id)[-1] == "failed"
+    job = client.get(f"/jobs/{job_id}").get_json()
+    assert job["error"] or job["failed"]
+
+
+@pytest.mark.pdf
+def test_converted_archive_is_downloaded_once(client, job_queue):
+    response = client.post("/convert", data=fixture.read_bytes())
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert sorted(pathlib.Path(name).suffix for name in archive.namelist()) == [".md", ".pdf"]
+    response.close()
+
+    assert client.get(f"/jobs/{response.headers['X-Remarks-Job-Id']}/archive").status_code == 410
+
+
+@pytest.mark.pdf
+def test_slow_conversion_is_downloaded_later(client, job_queue, monkeypatch):
+    monkeypatch.setattr(server, "CONVERT_WAIT", 0)
+
+    response = client.post("/convert", data=fixture.read_bytes())
+    assert response.status_code == 202
+    archive_url = response.get_json()["archive_url"]
+
+    deadline = time.time() + 120
+    while (response := client.get(archive_url)).status_code == 202:
+        assert time.time() < deadline
+        time.sleep(0.05)
+    assert response.status_code == 200
+    assert zipfile.is_zipfile(io.BytesIO(response.data))
+    response.close()
+
+    assert client.get(archive_url).status_code == 410
+
+
+@pytest.mark.pdf
+def test_failed_conversion_is_not_downloaded(client, job_queue, tmp_path):
+    response = client.post("/convert", data=broken_archive(tmp_path / fixture.name).read_bytes())
+    assert response.status_code == 500
+
+    assert client.get(f"/jobs/{response.get_json()['job_id']}/archive").status_code == 500
+
+
+def test_convert_rejects_anything_but_an_archive(client, job_queue):
+    assert client.post("/convert", data=b"not an archive").status_code == 400
@@ -1,6 +1,23 @@
-from rmscene.scene_items import GlyphRange, Rectangle, PenColor
+import importlib
+import logging
+import pathlib
+import random
+import string
 
-from remarks.output.ObsidianMarkdownFile import merge_highlights
+import fitz
+import pytest
+from rmc.exporters.svg import rmc_config, set_device
+from rmscene.scene_items import GlyphRange, Rectangle, PenColor, HARDCODED_COLORMAP
+
+from remarks.cache import RenderCache
+from remarks.output.ObsidianMarkdownFile import merge_highlights, calculate_highlight_distance, \
+    merge_highlight_texts
+from remarks.conversion.geometry import contained_in, intersects_any, rect_array, WordIndex
+from remarks.conversion.parsing import Highlight, ParsedPage
+from remarks.output.PdfFile import check_contain, coalesce_line_rects, highlight_rects, render_annotation_layer, \
+    get_highlight_color, FALLBACK_HIGHLIGHT_COLOR
+from remarks.sources import InputSource, ZipSource
+from remarks.utils import MetadataStore, get_visible_name, list_ann_rm_files
 
 
 def test_merge_highlights_where_start_is_missing():
@@ -18,3 +35,246 @@ def test_merge_highlights_where_start_is_missing():
                          rectangles=[Rectangle(x=202.4765625, y=276.1953125, w=360.578125, h=44.390625)])]
 
     merge_highlights(ranges)
+
+
+def _reference_merge_highlights(highlights):
+    """The original pairwise merge, which merge_highlights must stay identical to"""
+    merged_highlights = list(filter(lambda h: h is not None and type(h.start) is int, highlights.copy()))
+    while True:
+        merged_highlights.sort(key=lambda h: h.start)
+        merged_any = False
+        i = 0
+        while i < len(merged_highlights) - 1:
+            j = i + 1
+            while j < len(merged_highlights):
+                distance, end_of_h1, h1, h2 = calculate_highlight_distance(merged_highlights[i], merged_highlights[j])
+                if distance <= 3:
+                    new_start = min(h1.start, h2.start)
+                    merged_highlights[i] = GlyphRange(start=new_start,
+                                                      length=max(end_of_h1, h2.start + h2.length) - new_start,
+                                                      text=merge_highlight_texts(h1, h2, distance), color=h1.color,
+                                                      rectangles=h1.rectangles + h2.rectangles)
+                    merged_highlights.pop(j)
+                    merged_any = True
+                else:
+                    j += 1
+            i += 1
+        if not merged_any:
+            return merged_highlights
+
+
+def test_merge_highlights_matches_pairwise_merge():
+    rng = random.Random(1234)
+    colors = [PenColor.HIGHLIGHT, PenColor.YELLOW, PenColor.GREEN]
+    for _ in range(500):
+        ranges = []
+        for _ in range(rng.randint(0, 40)):
+            length = rng.randint(1, 12)
+            ranges.append(GlyphRange(
+                start=rng.choice([None] + list(range(200))) if rng.random() < 0.05 else rng.randint(0, 200),
+                length=length,
+                text="".join(rng.choice(string.ascii_lowercase + " ") for _ in range(length)),
+                color=rng.choice(colors),
+                rectangles=[Rectangle(x=rng.random(), y=rng.random(), w=1, h=1)]))
+
+        expected = _reference_merge_highlights(ranges)
+        actual = merge_highlights(ranges)
+        assert [(h.start, h.length, h.text, h.color, h.rectangles) for h in actual] == \
+               [(h.start, h.length, h.text, h.color, h.rectangles) for h in expected]
+
+
+def test_render_cache_evicts_least_recently_used_layers(tmp_path):
+    layer = fitz.open()
+    layer.new_page()
+    layer_size = len(layer.tobytes())
+
+    render_cache = RenderCache(tmp_path, max_size=2 * layer_size)
+    a, b, c = (RenderCache.key(rm_data, ["device", "RMPP"], False) for rm_data in [b"a", b"b", b"c"])
+    assert a != RenderCache.key(b"a", ["device", "RM2"], False)
+
+    render_cache.put(a, layer)
+    render_cache.put(b, layer)
+    assert render_cache.get(a).page_count == 1
+
+    render_cache.put(c, layer)
+    assert render_cache.get(b) is None
+    assert render_cache.get(a) is not None
+    assert render_cache.get(c) is not None
+
+
+def test_render_cache_only_lists_its_directory_when_full(tmp_path, monkeypatch):
+    layer = fitz.open()
+    layer.new_page()
+    layer_size = len(layer.tobytes())
+    render_cache = RenderCache(tmp_path, max_size=int(2.5 * layer_size))
+    # Another process sharing the cache
+    other_cache = RenderCache(tmp_path, max_size=int(2.5 * layer_size))
+
+    listings = []
+    entries = RenderCache._entries
+    monkeypatch.setattr(RenderCache, "_entries", lambda cache: listings.append(cache) or entries(cache))
+
+    render_cache.put(RenderCache.key(b"a"), layer)
+    other_cache.put(RenderCache.key(b"b"), layer)
+    other_cache.put(RenderCache.key(b"c"), layer)
+    render_cache.put(RenderCache.key(b"d"), layer)
+    assert listings == []
+    assert len(list(tmp_path.glob("*.pdf"))) == 4
+
+    # Over the limit as far as this process knows, the layers of the other process are counted as well
+    render_cache.put(RenderCache.key(b"e"), layer)
+    assert listings == [render_cache]
+    assert len(list(tmp_path.glob("*.pdf"))) == 2
+
+
+def test_metadata_store_is_scoped_to_a_run(tmp_path):
+    metadata_path = tmp_path / "0b2b7f5e.metadata"
+    metadata_path.write_text('{"visibleName": "Notes", "parent": "", "type": "DocumentType"}')
+
+    store = MetadataStore(tmp_path)
+    assert get_visible_name(metadata_path, store=store) == "Notes"
+
+    # Re-uploaded between two runs
+    metadata_path.write_text('{"visibleName": "Renamed", "parent": "", "type": "DocumentType"}')
+    assert get_visible_name(metadata_path, store=store) == "Notes"
+    assert get_visible_name(metadata_path, store=MetadataStore(tmp_path)) == "Renamed"
+    assert get_visible_name(metadata_path) == "Renamed"
+    assert store.subset(["0b2b7f5e"]).read(metadata_path)["visibleName"] == "Notes"
+
+
+def test_zip_source_reads_members_without_extracting():
+    archive = pathlib.Path("tests/in/empty_document.rmn")
+    with ZipSource(archive) as source:
+        [metadata_path] = source.glob(archive, "*.metadata")
+        assert metadata_path == archive / "e8bdf0c3-3edc-4c75-bf0e-09d09bf55272.metadata"
+
+        store = MetadataStore(archive, source)
+        assert get_visible_name(metadata_path, store=store) == "Empty"
+        assert store.read(archive / "missing.metadata") is None
+
+        [rm_file] = list_ann_rm_files(metadata_path, source)
+        assert rm_file.stem == "f7490f87-fafd-44d8-928a-00c5ea8318f2"
+        assert source.read_bytes(rm_file).startswith(b"reMarkable .lines file, version=6")
+
+
+def test_input_sources_implement_every_file_operation():
+    class ExistsOnly(InputSource):
+        def exists(self, path):
+            return True
+
+    with pytest.raises(TypeError):
+        ExistsOnly()
+
+
+def test_geometry_matches_fitz_rects():
+    rng = random.Random(42)
+
+    def random_rect():
+        # Coarse coordinates, so that touching, zero-width and inverted rectangles come up often
+        x0, y0 = rng.randint(0, 20) / 2, rng.randint(0, 20) / 2
+        return fitz.Rect(x0, y0, x0 + rng.randint(-2, 8) / 2, y0 + rng.randint(-2, 8) / 2)
+
+    for _ in range(200):
+        words = [random_rect() for _ in range(rng.randint(0, 30))]
+        rects = [random_rect() for _ in range(rng.randint(0, 5))]
+        word_boxes = rect_array(words)
+        word_index = WordIndex(words)
+
+        intersecting = [any(word.intersects(r) for r in rects) for word in words]
+        assert list(intersects_any(word_boxes, rect_array(rects))) == intersecting
+        assert list(word_index.intersecting(rects)) == intersecting
+        for r in rects:
+            points = [r.tl, r.tr, r.bl, r.br]
+            contained = [check_contain(fitz.Rect(word), points) for word in words]
+            assert list(contained_in(word_boxes, fitz.Quad(points).rect)) == contained
+            assert word_index.contained(fitz.Quad(points).rect) == \
+                   [word for word, is_contained in zip(words, contained) if is_contained]
+
+
+def test_coalesce_line_rects_joins_touching_rects_on_a_line():
+    rects = [
+        fitz.Rect(50, 10, 80, 20),
+        fitz.Rect(10, 10.5, 50, 20.5),
+        # A gap on the same line
+        fitz.Rect(100, 10, 120, 20),
+        # The next line
+        fitz.Rect(10, 30, 60, 40),
+    ]
+    assert coalesce_line_rects(rects) == [
+        fitz.Rect(10, 10, 80, 20.5),
+        fitz.Rect(100, 10, 120, 20),
+        fitz.Rect(10, 30, 60, 40),
+    ]
+
+
+def test_highlight_converters():
+    glyph_range = GlyphRange(start=3, length=9, text="two lines", color=PenColor.YELLOW, rectangles=[
+        Rectangle(x=10, y=40, w=30, h=10),
+        Rectangle(x=50, y=20, w=20, h=10),
+        Rectangle(x=10, y=20, w=30, h=10),
+    ])
+    highlight = Highlight.from_glyph_range(glyph_range)
+
+    # In reading order
+    assert highlight_rects(highlight, 5) == [
+        fitz.Rect(rmc_config.xx(10) + 5, rmc_config.yy(20), rmc_config.xx(10) + 5 + rmc_config.xx(30),
+                  rmc_config.yy(20) + rmc_config.yy(10)),
+        fitz.Rect(rmc_config.xx(50) + 5, rmc_config.yy(20), rmc_config.xx(50) + 5 + rmc_config.xx(20),
+                  rmc_config.yy(20) + rmc_config.yy(10)),
+        fitz.Rect(rmc_config.xx(10) + 5, rmc_config.yy(40), rmc_config.xx(10) + 5 + rmc_config.xx(30),
+                  rmc_config.yy(40) + rmc_config.yy(10)),
+    ]
+    assert highlight.to_glyph_range() == GlyphRange(start=3, length=9, text="two lines", color=PenColor.YELLOW,
+                                                    rectangles=[])
+
+
+def _reference_get_highlight_color(pen_color):
+    """The original lookup, which get_highlight_color must stay identical to"""
+    color_to_rgba = {v: k for k, v in HARDCODED_COLORMAP.items()}
+    try:
+        rgba = color_to_rgba.get(PenColor(pen_color), (255, 237, 117, 255))
+    except ValueError:
+        rgba = (255, 237, 117, 255)
+    r, g, b, _ = rgba
+    return (r / 255, g / 255, b / 255)
+
+
+def test_highlight_colors_match_the_colormap():
+    for pen_color in set(HARDCODED_COLORMAP.values()):
+        assert get_highlight_color(pen_color) == _reference_get_highlight_color(pen_color)
+        # Plain integers, as stored on a Highlight
+        assert get_highlight_color(pen_color.value) == _reference_get_highlight_color(pen_color.value)
+
+    # Known to rmscene, but not in the colormap
+    for pen_color in set(PenColor) - set(HARDCODED_COLORMAP.values()):
+        assert get_highlight_color(pen_color) == _reference_get_highlight_color(pen_color) == FALLBACK_HIGHLIGHT_COLOR
+    for unknown in (None, -1, 999):
+        assert get_highlight_color(unknown) == _reference_get_highlight_color(unknown) == FALLBACK_HIGHLIGHT_COLOR
+
+
+def test_in_memory_rendering_matches_temporary_file_rendering():
+    archive = pathlib.Path("tests/in/rmpp - v6 - various colors.rmn")
+    set_device("RMPP")
+    with ZipSource(archive) as source:
+        [metadata_path] = source.glob(archive, "*.metadata")
+        for rm_file in list_ann_rm_files(metadata_path, source):
+            scene_tree = ParsedPage.from_file(rm_file, source).scene_tree
+            from_file = render_annotation_layer(scene_tree)
+            in_memory = render_annotation_layer(scene_tree, in_memory=True)
+
+            assert in_memory.page_count == from_file.page_count == 1
+            assert in_memory[0].rect == from_file[0].rect
+            assert in_memory[0].get_pixmap().samples == from_file[0].get_pixmap().samples
+
+
+def test_failed_warm_up_only_logs_a_warning(monkeypatch, caplog):
+    import remarks.preload
+    import remarks.remarks
+
+    def broken_render_page(*args, **kwargs):
+        raise RuntimeError("no renderer")
+
+    monkeypatch.setattr(remarks.remarks, "render_page", broken_render_page)
+    with caplog.at_level(logging.WARNING):
+        importlib.reload(remarks.preload)
+    assert "Warming up failed" in caplog.text